@@ -3,16 +3,17 @@ from taskutils.ndbsharded import ndbshardedmap, futurendbshardedmap
 
 def DeleteAccountsWithShardedMapExperiment():
     def Go():
-        def DeleteAccount(account):
-            account.key.delete()
+        def DeleteAccount(account, pool):
+            pool.delete(account.key)
 
-        ndbshardedmap(DeleteAccount, ndbquery = Account.query())            
+        ndbshardedmap(DeleteAccount, ndbquery = Account.query(), pagemode = True, usepool = True)
     return "Delete Accounts With Sharded Map", Go
 
 def DeleteAccountsWithFutureShardedMapExperiment():
     def Go():
-        def DeleteAccount(account):
-            account.key.delete()
+        def DeleteAccount(futurekey, account, pool):
+            pool.delete(account.key)
+            return 1
 
-        return futurendbshardedmap(DeleteAccount, ndbquery = Account.query()).key
+        return futurendbshardedmap(DeleteAccount, ndbquery = Account.query(), usepool = True).key
     return "Delete Accounts With Future Sharded Map", Go
@@ -17,6 +17,17 @@ def IncrementAccountsWithShardedMapExperiment():
     return "Increment Accounts With Sharded Map", Go
 
 
+def IncrementAccountsWithShardedMapPageModeExperiment():
+    def Go():
+        def AddFreeCredit(creditamount):
+            def IncrementBalance(account):
+                account.balance += creditamount
+
+            ndbshardedmap(IncrementBalance, Account.query(), pagemode=True)
+        AddFreeCredit(10)
+    return "Increment Accounts With Sharded Map (page mode)", Go
+
+
 def IncrementAccountsWithFutureShardedMapExperiment():
     def Go():
         def AddFreeCredit(creditamount):
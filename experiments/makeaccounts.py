@@ -1,6 +1,6 @@
 from model.account import Account
 from google.appengine.ext import ndb
-from taskutils import task
+from taskutils import task, TaskBatch
 import logging
 def MakeAccountsExperiment():
     def Go():
@@ -17,10 +17,11 @@ def MakeAccountsExperiment():
                 ndb.put_multi(accounts)
             else:
                 doaccounts = numaccounts
-                while doaccounts > 0:
-                    batch = (numaccounts / 10) if ((numaccounts / 10) <= doaccounts) else doaccounts
-                    MakeAccounts(batch)
-                    doaccounts -= batch
+                with TaskBatch():
+                    while doaccounts > 0:
+                        batch = (numaccounts / 10) if ((numaccounts / 10) <= doaccounts) else doaccounts
+                        MakeAccounts(batch)
+                        doaccounts -= batch
         
         MakeAccounts(1000)
     return "Make Accounts", Go
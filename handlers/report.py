@@ -9,6 +9,8 @@ def get_report(app):
     def report():
         keystr = request.args.get('key')
         level = int(request.args.get('level', 0))
+        pagesize = int(request.args.get('pagesize', 100))
+        cursor = request.args.get('cursor')
         if keystr:
             key = ndb.Key(urlsafe=keystr)
             obj = key.get()
@@ -16,15 +18,21 @@ def get_report(app):
             def future_map(future, flevel):
                 if future:
                     urlsafe = future.key.urlsafe()
-                    return "<a href='report?key=%s&level=%s'>%s</a>" % (urlsafe, flevel, urlsafe)
+                    return "<a href='report?key=%s&level=%s&pagesize=%s'>%s</a>" % (urlsafe, flevel, pagesize, urlsafe)
                 else:
                     return None
 
-            obj_json = obj.to_dict(level=level, max_level=level + 5, future_map_fn=future_map)
+            obj_json = obj.to_dict(level=level, max_level=level + 5, future_map_fn=future_map, pagesize=pagesize,
+                                   cursor=cursor)
+            nexturl = None
+            if obj_json.get("zchildrencursor"):
+                nexturl = "report?key=%s&level=%s&pagesize=%s&cursor=%s" % (
+                    keystr, level, pagesize, obj_json["zchildrencursor"])
             return render_template(
                 "report.html",
                 objjson=json.dumps(obj_json, indent=2, sort_keys=True),
-                keystr=keystr
+                keystr=keystr,
+                nexturl=nexturl
             )
         else:
             return render_template(
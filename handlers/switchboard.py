@@ -2,7 +2,8 @@ from flask import render_template, request, redirect
 
 from experiments.incrementaccountsnaive import IncrementAccountsExperimentNaive
 from experiments.incrementaccountswithtask import IncrementAccountsWithTaskExperiment
-from experiments.incrementaccountswithshardedmap import IncrementAccountsWithShardedMapExperiment, IncrementAccountsWithFutureShardedMapExperiment
+from experiments.incrementaccountswithshardedmap import IncrementAccountsWithShardedMapExperiment, IncrementAccountsWithFutureShardedMapExperiment, \
+    IncrementAccountsWithShardedMapPageModeExperiment
 from experiments.deleteaccountswithshardedmap import DeleteAccountsWithShardedMapExperiment, DeleteAccountsWithFutureShardedMapExperiment
 from experiments.makeaccounts import MakeAccountsExperiment
 from experiments.countaccountswithfuture import CountAccountsWithFutureExperiment
@@ -14,6 +15,7 @@ def get_switchboard(app):
         CountAccountsWithFutureExperiment(),
         IncrementAccountsWithFutureShardedMapExperiment(),
         IncrementAccountsWithShardedMapExperiment(),
+        IncrementAccountsWithShardedMapPageModeExperiment(),
         IncrementAccountsWithTaskExperiment(),
         IncrementAccountsExperimentNaive(),
         DeleteAccountsWithShardedMapExperiment(),
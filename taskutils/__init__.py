@@ -4,7 +4,9 @@ TASKUTILS_LOGGING = False
 TASKUTILS_DUMP = False
 
 import taskutils.task as taskpy
-from taskutils.task import task, addrouteforwebapp, addrouteforwebapp2, get_taskroute, set_taskroute
+from taskutils.task import task, register_task, TaskBatch, wait_all, addrouteforwebapp, addrouteforwebapp2, get_taskroute, set_taskroute, \
+    get_compressthreshold, set_compressthreshold, get_spillstore, set_spillstore, get_backend, set_backend
+from taskutils.metrics import get_metricssink, set_metricssink
 from taskutils.flaskutil import setuptasksforflask
 from flask import Flask
 
@@ -0,0 +1,216 @@
+"""
+In-process backends for task(), selected with taskutils.set_backend().
+
+Tasks still go through the same pickling, _launch_task and _run path as they do on the task
+queue, they're just run inside the current process instead of by App Engine. Useful for
+tests, and for measuring fan-out strategies without dev_appserver's dispatch overhead.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from taskutils.task import _launch_task, get_taskroute
+from taskutils.util import logdebug, logwarning
+
+
+class _DoneRPC(object):
+    """Stands in for the RPC returned by Queue.add_async()."""
+
+    def __init__(self, result):
+        self._result = result
+
+    def wait(self):
+        pass
+
+    def get_result(self):
+        return self._result
+
+
+class TaskHeaders(dict):
+    """Case insensitive headers, like the ones webapp and flask hand to _launch_task."""
+
+    def __init__(self, headers):
+        dict.__init__(self, ((key.lower(), value) for key, value in headers.items()))
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+
+class _ScheduledTask(object):
+    def __init__(self, t, name, queue):
+        self.task = t
+        self.name = name
+        self.queue = queue
+        self.retrycount = 0
+
+
+class _InProcessBackend(object):
+    def __init__(self, maxretries=5, minbackoffsec=0.1, maxbackoffsec=10):
+        self.maxretries = maxretries
+        self.minbackoffsec = minbackoffsec
+        self.maxbackoffsec = maxbackoffsec
+        self._lock = threading.RLock()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._names = set()
+
+    def add(self, tasks, queue, transactional):
+        tasklist = tasks if isinstance(tasks, list) else [tasks]
+        scheduled = self._make_scheduled(tasklist, queue)
+
+        def schedule():
+            for item in scheduled:
+                self._push(item, item.task.eta_posix)
+            self._on_added()
+
+        if transactional:
+            # like a transactional add, nothing happens unless the transaction commits
+            ndb.get_context().call_on_commit(schedule)
+        else:
+            schedule()
+        return tasks
+
+    def add_async(self, tasks, queue, transactional):
+        return _DoneRPC(self.add(tasks, queue, transactional))
+
+    def _make_scheduled(self, tasklist, queue):
+        with self._lock:
+            # like a bulk add, either every task is added or (if any name is taken) none are
+            names = [t.name if t.name else "task%s" % next(self._sequence) for t in tasklist]
+            for name in names:
+                if name in self._names:
+                    raise taskqueue.TaskAlreadyExistsError("task %s already exists" % name)
+            if len(set(names)) < len(names):
+                raise taskqueue.DuplicateTaskNameError("duplicate task names in one add")
+            self._names.update(names)
+        for t in tasklist:
+            # what Queue.add sets, so callers can tell which tasks made it
+            t._Task__enqueued = True
+        return [_ScheduledTask(t, name, queue) for t, name in zip(tasklist, names)]
+
+    def _push(self, item, eta):
+        with self._lock:
+            heapq.heappush(self._heap, (eta, next(self._sequence), item))
+
+    def _on_added(self):
+        pass
+
+    def _execute(self, item):
+        t = item.task
+        headers = dict(t.headers)
+        headers.update({
+            "X-AppEngine-TaskName": item.name,
+            "X-AppEngine-QueueName": item.queue,
+            "X-AppEngine-TaskRetryCount": str(item.retrycount),
+            "X-AppEngine-TaskExecutionCount": str(item.retrycount),
+            "X-AppEngine-TaskETA": str(t.eta_posix),
+        })
+        name = t.tag if t.method == "PULL" else t.url[len(get_taskroute()) + 1:]
+        try:
+            # a fresh context per task, like a separate request
+            ndb.toplevel(_launch_task)(t.payload, name, TaskHeaders(headers))
+        except Exception:
+            retrylimit = t.retry_options.task_retry_limit if t.retry_options else None
+            retrylimit = retrylimit if retrylimit is not None else self.maxretries
+            if item.retrycount < retrylimit:
+                backoffsec = min(self.maxbackoffsec, self.minbackoffsec * (2 ** item.retrycount))
+                item.retrycount += 1
+                logdebug("retrying %s (%s) in %ss", item.name, item.retrycount, backoffsec)
+                self._push(item, time.time() + backoffsec)
+                self._on_added()
+            else:
+                logwarning("giving up on %s after %s retries", item.name, item.retrycount)
+
+
+class InlineBackend(_InProcessBackend):
+    """Runs tasks synchronously in the calling thread.
+
+    Tasks run as soon as they're enqueued, or when the enclosing transaction commits, and tasks
+    they enqueue in turn are run in eta order by the same loop, rather than recursively.
+    Failed tasks are retried with exponential backoff, up to the task's task_retry_limit or
+    maxretries.
+
+    Args:
+      sleep: If True, wait for each task's eta (countdown) to arrive. Otherwise etas only
+        decide the order tasks run in.
+    """
+
+    def __init__(self, sleep=False, **kwargs):
+        super(InlineBackend, self).__init__(**kwargs)
+        self.sleep = sleep
+        self._running = False
+
+    def _on_added(self):
+        # never run tasks inside the caller's transaction, they'd see uncommitted state
+        ndb.get_context().call_on_commit(self._run_if_idle)
+
+    def _run_if_idle(self):
+        if not self._running:
+            self.run()
+
+    def run(self):
+        """Runs tasks until there are none left."""
+        self._running = True
+        try:
+            while self._heap:
+                eta, _, item = heapq.heappop(self._heap)
+                if self.sleep and eta > time.time():
+                    time.sleep(eta - time.time())
+                self._execute(item)
+        finally:
+            self._running = False
+
+
+class ThreadPoolBackend(_InProcessBackend):
+    """Runs tasks on a bounded pool of worker threads, each task waiting for its eta.
+
+    Failed tasks are retried with exponential backoff, up to the task's task_retry_limit or
+    maxretries. Call join() to wait until all tasks, including the ones they enqueue, are done.
+
+    Args:
+      numthreads: Maximum number of tasks to run at once.
+    """
+
+    def __init__(self, numthreads=10, **kwargs):
+        super(ThreadPoolBackend, self).__init__(**kwargs)
+        self._condition = threading.Condition(self._lock)
+        self._active = 0
+        self._threads = [threading.Thread(target=self._work) for _ in range(numthreads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _on_added(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, _, item = heapq.heappop(self._heap)
+                self._active += 1
+            try:
+                self._execute(item)
+            finally:
+                with self._condition:
+                    self._active -= 1
+                    self._condition.notify_all()
+
+    def join(self):
+        """Waits until there are no tasks queued or running."""
+        with self._condition:
+            while self._heap or self._active:
+                self._condition.wait(1)
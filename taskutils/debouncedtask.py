@@ -30,19 +30,19 @@ def debouncedtask(f=None, initsec=0, repeatsec=10, debouncename=None, **taskkwar
         retval = None
         client = memcache.Client()
         cachekey = "dt%s" % (debouncename if debouncename else make_flash(f, args, kwargs))
-        logdebug("cachekey: %s" % cachekey)
+        logdebug("cachekey: %s", cachekey)
         tries = 1
         maxtries = 400
         cont = True
         while cont and tries <= maxtries:
-            logdebug("tries=%s" % tries)
+            logdebug("tries=%s", tries)
             cont = False
             eta = client.gets(cachekey)
-            logdebug("eta: %s" % eta)
+            logdebug("eta: %s", eta)
             now = datetime.utcnow()
-            logdebug("now: %s" % now)
+            logdebug("now: %s", now)
             nowplusinit = now + timedelta(seconds=initsec)
-            logdebug("nowplusinit: %s" % nowplusinit)
+            logdebug("nowplusinit: %s", nowplusinit)
             if not eta or eta < nowplusinit:
                 logdebug("A")
                 if not eta:
@@ -65,17 +65,17 @@ def debouncedtask(f=None, initsec=0, repeatsec=10, debouncename=None, **taskkwar
                 if countdown < initsec:
                     countdown = initsec  # don't schedule anything closer than initsec to now.
 
-                logdebug("countdown: %s" % countdown)
+                logdebug("countdown: %s", countdown)
 
                 nexteta = now + timedelta(seconds=countdown)
 
-                logdebug("nexteta: %s" % nexteta)
+                logdebug("nexteta: %s", nexteta)
 
                 if eta is None:
                     casresult = client.add(cachekey, nexteta)
                 else:
                     casresult = client.cas(cachekey, nexteta)
-                logdebug("CAS result: %s" % casresult)
+                logdebug("CAS result: %s", casresult)
                 if casresult or tries == maxtries:
                     if tries == maxtries:
                         logdebug(
@@ -99,7 +99,7 @@ def debouncedtask(f=None, initsec=0, repeatsec=10, debouncename=None, **taskkwar
         #                     sleep(tries)
 
         # else we're already scheduled to run far enough into  the future, So, let's just stop
-        logdebug("leave rundebouncedtask: cont=%s, tries=%s" % (cont, tries))
+        logdebug("leave rundebouncedtask: cont=%s, tries=%s", cont, tries)
         return retval
 
     return rundebouncedtask
@@ -3,17 +3,21 @@ import functools
 import hashlib
 import json
 import pickle
+import random
 import time
 import uuid
 from copy import deepcopy
 
 import cloudpickle
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api.datastore_errors import Timeout
 from google.appengine.ext import ndb
 
 from taskutils import task
-from taskutils.task import PermanentTaskFailure
+from taskutils.mutationpool import MutationPool
+from taskutils.spill import DatastoreChunkStore
+from taskutils.task import PermanentTaskFailure, _add_task, _add_tasks_async, _MAX_TASKS_PER_ADD
 from taskutils.util import logdebug, logwarning, logexception
 
 
@@ -39,11 +43,230 @@ class _FutureProgress(ndb.Model):
     weight = ndb.IntegerProperty()
 
 
+class _FutureCounter(ndb.Model):
+    """One shard of a counter belonging to a future. See _increment_counter."""
+    _use_cache = False
+    _use_memcache = False
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+# children of one future update its counters in parallel, so spread the writes over this many entities
+_COUNTER_SHARDS = 10
+
+
+def _counter_keys(futurekey, countername):
+    return [ndb.Key(_FutureCounter, "%s-%s-%s" % (futurekey.id(), countername, shard))
+            for shard in range(_COUNTER_SHARDS)]
+
+
+def _increment_counter(futurekey, countername, delta=1):
+    """Adds delta to one shard of a future's counter.
+
+    Call this in the (xg) transaction that makes the change being counted, so it's counted exactly once.
+    """
+    key = random.choice(_counter_keys(futurekey, countername))
+    counter = key.get() or _FutureCounter(key=key)
+    counter.count += delta
+    counter.put()
+
+
+def _get_counters(futurekey, *counternames):
+    """Returns the current values of a future's counters, in the order given."""
+    keys = [_counter_keys(futurekey, countername) for countername in counternames]
+    counters = ndb.get_multi([key for shardkeys in keys for key in shardkeys])
+    return [
+        sum(counter.count for counter in counters[index * _COUNTER_SHARDS:(index + 1) * _COUNTER_SHARDS] if counter)
+        for index in range(len(counternames))
+    ]
+
+
+class _FutureAccumulator(ndb.Model):
+    """One shard of the running combined result of a future's children. See _OnAllChildSuccess."""
+    _use_cache = False
+    _use_memcache = False
+
+    valueser = ndb.BlobProperty()
+    valuerefser = ndb.BlobProperty()  # for big values, kept in the result store like big results
+    errorser = ndb.BlobProperty()  # set if combining failed, the parent fails with it
+
+
+def _accumulator_keys(futurekey):
+    return [ndb.Key(_FutureAccumulator, "%s-%s" % (futurekey.id(), shard)) for shard in range(_COUNTER_SHARDS)]
+
+
+# progress tasks for a future are run at most once per interval of this many seconds
+_DEBOUNCE_SEC = 5
+
+# progress and status are also kept in memcache, so they're cheap to poll. See get_futureprogress.
+_PROGRESS_CACHE_PREFIX = "futureprogress-"
+_LOCALPROGRESS_CACHE_PREFIX = "futurelocalprogress-"
+_STATUS_CACHE_PREFIX = "futurestatus-"
+_CACHE_EXPIRESEC = 24 * 60 * 60
+# the progress entity's cached copy is set after its transaction commits, so two writers can set it out
+# of order. It expires soon, so a stale copy is only seen for a little while.
+_PROGRESS_CACHE_EXPIRESEC = 30
+_DEBOUNCE_CACHE_PREFIX = "futuredebounce-"
+
+
+def _progress_dict(progressobj):
+    return {
+        "localprogress": progressobj.localprogress or 0 if progressobj else 0,
+        "calculatedprogress": progressobj.calculatedprogress or 0 if progressobj else 0,
+        "weight": progressobj.weight or None if progressobj else None
+    }
+
+
+def _cache_progress(futurekey, progressobj):
+    memcache.set("%s%s" % (_PROGRESS_CACHE_PREFIX, futurekey.id()), _progress_dict(progressobj),
+                 time=_PROGRESS_CACHE_EXPIRESEC)
+
+
+def _cache_status(futurekey, status):
+    # underway is cached as "", because None means not cached
+    memcache.set("%s%s" % (_STATUS_CACHE_PREFIX, futurekey.id()), status or "", time=_CACHE_EXPIRESEC)
+
+
+# results that pickle to more than this are stored outside the _Future entity, see set_resultstore
+_MAX_INLINE_RESULT_BYTES = 500 * 1024
+
+FUTURE_RESULTSTORE = DatastoreChunkStore(prefix="futureresult")
+FUTURE_RESULTTHRESHOLD = _MAX_INLINE_RESULT_BYTES
+
+
+def set_resultstore(store, threshold=None):
+    """Sets where large future results are stored.
+
+    Args:
+      store: A store with write(data) -> ref, read(ref) and delete(ref), as for task.set_spillstore.
+        Defaults to spill.DatastoreChunkStore, use spill.GCSSpillStore for really big results.
+      threshold: Results that pickle to more than this many bytes go to the store, smaller ones
+        are kept in the _Future entity.
+    """
+    global FUTURE_RESULTSTORE, FUTURE_RESULTTHRESHOLD
+    FUTURE_RESULTSTORE = store
+    FUTURE_RESULTTHRESHOLD = threshold if threshold is not None else _MAX_INLINE_RESULT_BYTES
+
+
+def get_resultstore():
+    global FUTURE_RESULTSTORE
+    return FUTURE_RESULTSTORE
+
+
+def _delete_stored_result(resultrefser):
+    if resultrefser:
+        store, ref, _ = pickle.loads(resultrefser)
+        store.delete(ref)
+
+
+def _delete_stored_results(resultrefsers):
+    """Deletes results stored by a transaction attempt that didn't commit, and empties the list."""
+    for resultrefser in resultrefsers:
+        _delete_stored_result(resultrefser)
+    del resultrefsers[:]
+
+
+def _deserialize_result(resultser, resultrefser):
+    """Loads a result saved with _serialize_result."""
+    if resultrefser:
+        store, ref, _ = pickle.loads(resultrefser)
+        resultser = store.read(ref)
+        if resultser is None:
+            raise Exception("result is missing from %s" % ref)
+    return pickle.loads(resultser) if resultser else None
+
+
+def _serialize_result(result):
+    """Returns (resultser, resultrefser) for a result; one of them is None.
+
+    Big results are written to the result store here, outside any transaction.
+    """
+    resultser = cloudpickle.dumps(result)
+    store = get_resultstore()
+    if not store or len(resultser) <= FUTURE_RESULTTHRESHOLD:
+        return resultser, None
+    ref = store.write(resultser)
+    return None, cloudpickle.dumps((store, ref, len(resultser)))
+
+
+# ids of futures in the flat layout start with this, see future()
+_FLAT_ID_PREFIX = "flat-"
+
+
+def _is_flat(futurekey):
+    return isinstance(futurekey.id(), basestring) and futurekey.id().startswith(_FLAT_ID_PREFIX)
+
+
+# arguments of future() and future_many() that aren't passed on to task()
+_FUTURE_ONLY_KWARGS = ("parentkey", "onsuccessf", "onfailuref", "onallchildsuccessf", "onprogressf", "weight",
+                       "timeoutsec", "maxretries", "futurename", "futurenameprefix", "flat")
+
+
+def get_taskonlykwargs(kwargs):
+    """Returns the arguments in kwargs that are for task(), leaving out the ones only future() takes.
+
+    For code that's given kwargs meant for future() (eg: the sharded maps) and also adds plain tasks.
+    """
+    return dict((key, value) for key, value in kwargs.items() if key not in _FUTURE_ONLY_KWARGS)
+
+
+def _addtask(futurekey, taskkwargs, nameprefix, countdown, f, args, kwargs):
+    """Runs f(*args, **kwargs) in a task for a future, named for the future if nameprefix is given."""
+    taskkwargs = dict(taskkwargs)
+    name = ""
+    if nameprefix:
+        name = "%s-%s" % (nameprefix, futurekey.id())
+        taskkwargs["name"] = name
+    elif taskkwargs.get("name"):
+        del taskkwargs["name"]
+    taskkwargs["transactional"] = False
+    if countdown is not None:
+        taskkwargs.pop("eta", None)
+        taskkwargs["countdown"] = countdown
+
+    @task(**taskkwargs)
+    def dof():
+        f(*args, **kwargs)
+
+    try:
+        # run the wrapper task, and if it fails due to a name clash just skip it (it was already kicked off by an earlier
+        # attempt to construct this future).
+        #             logdebug("about to run task %s" % name)
+        dof()
+    except taskqueue.TombstonedTaskError:
+        logdebug("skip adding task %s (already been run)", name)
+    except taskqueue.TaskAlreadyExistsError:
+        logdebug("skip adding task %s (already running)", name)
+
+
+def _addtask_debounced(futurekey, gettaskkwargs, nameprefix, f, args, kwargs):
+    """Adds a task for the current _DEBOUNCE_SEC interval, unless one's been added already.
+
+    gettaskkwargs is only called if the task is actually added.
+    """
+    now = time.time()
+    bucket = int(now / _DEBOUNCE_SEC)
+    prefix = "%s%s" % (nameprefix, bucket)
+    # most calls in an interval come after its task was added, so check memcache before trying the queue
+    guardkey = "%s%s-%s" % (_DEBOUNCE_CACHE_PREFIX, prefix, futurekey.id())
+    if not memcache.add(guardkey, 1, time=_DEBOUNCE_SEC * 2) and memcache.get(guardkey) is not None:
+        return
+    # add also fails if memcache is unavailable, and then the get finds nothing. The task is added
+    # anyway, as it's named for the interval a duplicate is just rejected by the queue.
+    try:
+        _addtask(futurekey, gettaskkwargs(), prefix, (bucket + 1) * _DEBOUNCE_SEC - now, f, args, kwargs)
+    except Exception:
+        # so a later call in the interval tries again
+        memcache.delete(guardkey)
+        raise
+
+
 class _Future(ndb.Model):
     stored = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True)
     parentkey = ndb.KeyProperty()
     resultser = ndb.BlobProperty()
+    resultrefser = ndb.BlobProperty()  # (store, ref, bytes) for results stored elsewhere, see set_resultstore
     exceptionser = ndb.BlobProperty()
     onsuccessfser = ndb.BlobProperty()
     onfailurefser = ndb.BlobProperty()
@@ -56,6 +279,7 @@ class _Future(ndb.Model):
     readyforresult = ndb.BooleanProperty()
     timeoutsec = ndb.IntegerProperty()
     name = ndb.StringProperty()
+    countschildren = ndb.BooleanProperty(indexed=False)  # children are counted, see _get_counters
 
     def get_taskkwargs(self, deletename=True):
         taskkwargs = pickle.loads(self.taskkwargsser)
@@ -66,28 +290,17 @@ class _Future(ndb.Model):
         return taskkwargs
 
     def intask(self, nameprefix, f, *args, **kwargs):
-        taskkwargs = self.get_taskkwargs()
-        name = ""
-        if nameprefix:
-            name = "%s-%s" % (nameprefix, self.key.id())
-            taskkwargs["name"] = name
-        elif taskkwargs.get("name"):
-            del taskkwargs["name"]
-        taskkwargs["transactional"] = False
+        self._addtask(nameprefix, None, f, args, kwargs)
 
-        @task(**taskkwargs)
-        def dof():
-            f(*args, **kwargs)
+    def intask_debounced(self, nameprefix, f, *args, **kwargs):
+        """Like intask, but runs f at most once every _DEBOUNCE_SEC, at the end of the interval.
 
-        try:
-            # run the wrapper task, and if it fails due to a name clash just skip it (it was already kicked off by an earlier
-            # attempt to construct this future).
-            #             logdebug("about to run task %s" % name)
-            dof()
-        except taskqueue.TombstonedTaskError:
-            logdebug("skip adding task %s (already been run)" % name)
-        except taskqueue.TaskAlreadyExistsError:
-            logdebug("skip adding task %s (already running)" % name)
+        Calls made in the same interval share one task, so f must not care which call it was.
+        """
+        _addtask_debounced(self.key, self.get_taskkwargs, nameprefix, f, args, kwargs)
+
+    def _addtask(self, nameprefix, countdown, f, args, kwargs):
+        _addtask(self.key, self.get_taskkwargs(), nameprefix, countdown, f, args, kwargs)
 
     def has_result(self):
         return bool(self.status)
@@ -96,10 +309,23 @@ class _Future(ndb.Model):
         if self.status == "failure":
             raise pickle.loads(self.exceptionser)
         elif self.status == "success":
-            return pickle.loads(self.resultser)
+            return self._load_result()
         else:
             raise FutureReadyForResult("result not ready")
 
+    def _load_result(self):
+        # results are only unpickled (and fetched, if they're stored elsewhere) when they're asked for,
+        # then kept, so reading many futures to look at their status stays cheap.
+        if getattr(self, "_loadedresult", None) is None:
+            self._loadedresult = (_deserialize_result(self.resultser, self.resultrefser),)
+        return self._loadedresult[0]
+
+    def get_resultbytes(self):
+        """Returns the size of the pickled result, without loading it if it's stored elsewhere."""
+        if self.resultrefser:
+            return pickle.loads(self.resultrefser)[2]
+        return len(self.resultser) if self.resultser else 0
+
     def _get_progressobject(self):
         key = ndb.Key(_FutureProgress, self.key.id())
         progressobj = key.get()
@@ -120,6 +346,11 @@ class _Future(ndb.Model):
         return progressobj.localprogress if progressobj and progressobj.localprogress else 0
 
     def _calculate_progress(self, localprogress):
+        if self.countschildren:
+            childprogress, = _get_counters(self.key, "childprogress")
+            return localprogress + childprogress
+
+        # futures created before children were counted
         newcalculatedprogress = localprogress
 
         @ndb.transactional()
@@ -156,6 +387,34 @@ class _Future(ndb.Model):
 
         return get_children_trans()
 
+    def _has_children(self):
+        if self.countschildren:
+            childcount, = _get_counters(self.key, "children")
+            return bool(childcount)
+        return bool(self.GetChildren())
+
+    def _all_children_succeeded(self):
+        """Like all_children_success, but reads this future's child counters instead of all its children.
+
+        Children are counted in the transactions that create them and that set their success, so once
+        this future is ready for its result (ie: has made all its children), this is exact.
+        """
+        if not self.countschildren:
+            return all_children_success(self.key)
+        childcount, childsuccesscount = _get_counters(self.key, "children", "childsuccess")
+        return childsuccesscount >= childcount
+
+    def _update_parent_for_success(self, result, storedrefsers):
+        """Called in the transaction that sets this future's success, to count it (and maybe its result) in its parent.
+
+        Refs of accumulator values written to the result store are added to storedrefsers.
+        """
+        if self.parentkey:
+            _increment_counter(self.parentkey, "childsuccess")
+            onallchildsuccessf = pickle.loads(self.onallchildsuccessfser) if self.onallchildsuccessfser else None
+            if getattr(onallchildsuccessf, "incremental", False):
+                onallchildsuccessf.accumulate(result, storedrefsers)
+
     def _callOnSuccess(self):
         onsuccessf = pickle.loads(self.onsuccessfser) if self.onsuccessfser else None
         if onsuccessf:
@@ -166,7 +425,7 @@ class _Future(ndb.Model):
 
         if self.onallchildsuccessfser:
             lparent = self.GetParent()
-            if lparent and all_children_success(self.parentkey):
+            if lparent and lparent._all_children_succeeded():
                 onallchildsuccessf = pickle.loads(self.onallchildsuccessfser) if self.onallchildsuccessfser else None
                 if onallchildsuccessf:
                     def doonallchildsuccessf():
@@ -191,7 +450,7 @@ class _Future(ndb.Model):
             def doonprogressf():
                 onprogressf(self.key)
 
-            self.intask(None, doonprogressf)
+            self.intask_debounced("onprogress", doonprogressf)
 
     def get_runtime(self):
         if self.runtimesec:
@@ -201,13 +460,18 @@ class _Future(ndb.Model):
 
     def _set_local_progress_for_success(self):
         progressObj = self._get_progressobject()
-        logdebug("progressObj = %s" % progressObj)
+        logdebug("progressObj = %s", progressObj)
         weight = self.get_weight(progressObj)
         weight = weight or 1
-        logdebug("weight = %s" % weight)
+        logdebug("weight = %s", weight)
         localprogress = self.get_localprogress(progressObj)
-        logdebug("localprogress = %s" % localprogress)
-        if localprogress < weight and not self.GetChildren():
+        logdebug("localprogress = %s", localprogress)
+        # write out progress from setlocalprogress that hasn't been flushed yet, the flush won't happen now
+        pending = memcache.get("%s%s" % (_LOCALPROGRESS_CACHE_PREFIX, self.key.id()))
+        if pending is not None and pending != localprogress:
+            self.set_localprogress(pending)
+            localprogress = pending
+        if localprogress < weight and not self._has_children():
             logdebug("No children, we can auto set localprogress from weight")
             self.set_localprogress(weight)
 
@@ -215,25 +479,42 @@ class _Future(ndb.Model):
     @ndb.non_transactional()
     def set_success(self, result):
         key = self.key
+        resultser, resultrefser = _serialize_result(result)
+        storedrefsers = []
 
-        @ndb.transactional()
+        @ndb.transactional(xg=True)
         def _set_status():
+            # this is a retry if there are any, and nothing refers to what the last attempt stored
+            _delete_stored_results(storedrefsers)
             obj = key.get()
             did_put = False
             if obj.readyforresult and not obj.status:
                 obj.status = "success"
                 obj.initialised = True
                 obj.readyforresult = True
-                obj.resultser = cloudpickle.dumps(result)
+                obj.resultser = resultser
+                obj.resultrefser = resultrefser
                 obj.runtimesec = obj.get_runtime().total_seconds()
                 did_put = True
                 obj.put()
+                obj._update_parent_for_success(result, storedrefsers)
             return obj, did_put
 
-        entity, changed = _set_status()
+        try:
+            entity, changed = _set_status()
+        except Timeout:
+            # it may have committed after all
+            raise
+        except Exception:
+            _delete_stored_results(storedrefsers + [resultrefser])
+            raise
         if changed:
+            _cache_status(key, entity.status)
             entity._set_local_progress_for_success()
             entity._callOnSuccess()
+        else:
+            # the future already had a result, so ours was never used
+            _delete_stored_result(resultrefser)
 
     @ndb.non_transactional()
     def set_failure(self, exception):
@@ -255,6 +536,7 @@ class _Future(ndb.Model):
 
         entity, changed = _set_status()
         if changed:
+            _cache_status(key, entity.status)
             # noinspection PyProtectedMember
             entity._callOnFailure()
 
@@ -276,25 +558,42 @@ class _Future(ndb.Model):
     @ndb.non_transactional()
     def set_success_and_readyforesult(self, result):
         key = self.key
+        resultser, resultrefser = _serialize_result(result)
+        storedrefsers = []
 
-        @ndb.transactional()
+        @ndb.transactional(xg=True)
         def _set_status():
+            # this is a retry if there are any, and nothing refers to what the last attempt stored
+            _delete_stored_results(storedrefsers)
             obj = key.get()
             did_put = False
             if not obj.status:
                 obj.status = "success"
                 obj.initialised = True
                 obj.readyforresult = True
-                obj.resultser = cloudpickle.dumps(result)
+                obj.resultser = resultser
+                obj.resultrefser = resultrefser
                 obj.runtimesec = obj.get_runtime().total_seconds()
                 did_put = True
                 obj.put()
+                obj._update_parent_for_success(result, storedrefsers)
             return obj, did_put
 
-        entity, changed = _set_status()
+        try:
+            entity, changed = _set_status()
+        except Timeout:
+            # it may have committed after all
+            raise
+        except Exception:
+            _delete_stored_results(storedrefsers + [resultrefser])
+            raise
         if changed:
+            _cache_status(key, entity.status)
             entity._set_local_progress_for_success()
             entity._callOnSuccess()
+        else:
+            # the future already had a result, so ours was never used
+            _delete_stored_result(resultrefser)
 
     @ndb.non_transactional()
     def set_readyforesult(self):
@@ -324,36 +623,45 @@ class _Future(ndb.Model):
         _set_status()
 
     def _calculate_parent_progress(self):
-        parent_key = self.parentkey
-        if parent_key:
-            task_kwargs = self.get_taskkwargs()
+        parent = self.GetParent()
+        if parent and isinstance(parent, _Future):
+            parent_key = parent.key
 
-            @task(**task_kwargs)
             def _parent_progress():
-                parent = parent_key.get()
-                if parent and isinstance(parent, _Future):
-                    parent.calculate_progress()
+                parent2 = parent_key.get()
+                if parent2:
+                    parent2.calculate_progress()
 
-            _parent_progress()
+            # the children's progress is already added up in the parent's counters, so however
+            # many children change in an interval, the parent only needs to catch up once.
+            parent.intask_debounced("progress", _parent_progress)
 
     def set_localprogress(self, value):
-        obj = self._get_progressobject()
-        local = self.get_localprogress(obj)
-        calculated = self.get_calculatedprogress(obj)
-        if local != value:
-            #             haschildren = self.GetChildren()
-            #             logdebug("haschildren: %s" % haschildren)
+        @ndb.transactional(xg=True)
+        def _set_progress():
+            obj = self._get_progressobject()
+            local = self.get_localprogress(obj)
+            calculated = self.get_calculatedprogress(obj)
+            if local == value:
+                return False, False, obj
 
             obj.localprogress = value
-            logdebug("localprogress: %s" % value)
-            #             if not haschildren:
+            logdebug("localprogress: %s", value)
             changed = value > calculated
             if changed:
                 logdebug("setting calculated progress")
                 obj.calculatedprogress = value
+                if self.parentkey:
+                    _increment_counter(self.parentkey, "childprogress", value - calculated)
 
             obj.put()
+            return True, changed, obj
 
+        updated, changed, progressobj = _set_progress()
+        if updated:
+            _cache_progress(self.key, progressobj)
+            # so a pending flush of an older value from setlocalprogress doesn't undo this
+            memcache.set("%s%s" % (_LOCALPROGRESS_CACHE_PREFIX, self.key.id()), value, time=_CACHE_EXPIRESEC)
             if changed:
                 logdebug("kicking off calculate parent progress")
                 self._calculate_parent_progress()
@@ -361,13 +669,22 @@ class _Future(ndb.Model):
             self._callOnProgress()
 
     def calculate_progress(self):
-        obj = self._get_progressobject()
-        local = self.get_localprogress(obj)
-        calculated = self.get_calculatedprogress(obj)
-        new_calculated = self._calculate_progress(local)
-        if calculated != new_calculated:
+        @ndb.transactional(xg=True)
+        def _set_progress(new_calculated):
+            obj = self._get_progressobject()
+            calculated = self.get_calculatedprogress(obj)
+            if calculated == new_calculated:
+                return None
             obj.calculatedprogress = new_calculated
             obj.put()
+            if self.parentkey:
+                _increment_counter(self.parentkey, "childprogress", new_calculated - calculated)
+            return obj
+
+        # children are read outside the transaction, there can be too many of them to read inside one
+        progressobj = _set_progress(self._calculate_progress(self.get_localprogress()))
+        if progressobj:
+            _cache_progress(self.key, progressobj)
             self._calculate_parent_progress()
             self._callOnProgress()
 
@@ -377,6 +694,7 @@ class _Future(ndb.Model):
             if progress_obj.weight != value:
                 progress_obj.weight = value
                 progress_obj.put()
+                _cache_progress(self.key, progress_obj)
 
     def cancel(self):
         children = get_children(self.key)
@@ -394,15 +712,27 @@ class _Future(ndb.Model):
 
         self.set_failure(FutureCancelled("cancelled by caller"))
 
-    def to_dict(self, level=0, max_level=5, recursive=True, future_map_fn=None):
-        progress_obj = self._get_progressobject()
+    def to_dict(self, level=0, max_level=5, recursive=True, future_map_fn=None, pagesize=None, cursor=None):
+        """Returns this future and its descendants as a dict, for reports.
+
+        The tree is loaded a level at a time (see load_futuretree), so this takes a few RPCs per level,
+        however many futures there are.
 
-        children = [child.to_dict(level=level + 1, max_level=max_level, future_map_fn=future_map_fn) for child in
-                    get_children(self.key)] if recursive and level + 1 < max_level else None
+        Args:
+          pagesize: If given, include at most this many children of each future. The rest can be
+            fetched by passing the future's "zchildrencursor" back as cursor.
+          cursor: Where to start this future's children.
+        """
+        return load_futuretree([self], level=level, max_level=max_level if recursive else level + 1,
+                               future_map_fn=future_map_fn, pagesize=pagesize, cursor=cursor)[0]
 
+    def _to_dict_node(self, level, future_map_fn, progress, childcount):
         result_rep = None
-        result = pickle.loads(self.resultser) if self.resultser else None
-        if result:
+        # don't fetch results that are stored elsewhere just to show them
+        result = self._load_result() if self.resultser else None
+        if self.resultrefser:
+            result_rep = {"storedbytes": self.get_resultbytes()}
+        elif result:
             # noinspection PyBroadException
             try:
                 result_rep = result.to_dict()
@@ -430,12 +760,13 @@ class _Future(ndb.Model):
             "result": result_rep,
             "exception": repr(pickle.loads(self.exceptionser)) if self.exceptionser else None,
             "runtimesec": self.get_runtime().total_seconds(),
-            "localprogress": self.get_localprogress(progress_obj),
-            "progress": self.get_calculatedprogress(progress_obj),
-            "weight": self.get_weight(),
+            "localprogress": progress["localprogress"],
+            "progress": progress["calculatedprogress"],
+            "weight": progress["weight"],
             "initialised": self.initialised,
             "readyforresult": self.readyforresult,
-            "zchildren": children
+            "childcount": childcount,
+            "zchildren": None
         }
 
 
@@ -464,35 +795,118 @@ def DefaultOnFailure(futurekey):
             parentfutureobj.set_failure(ex)
 
 
-def GenerateOnAllChildSuccess(parentkey, initialvalue, combineresultf, failonerror=True):
-    def OnAllChildSuccess():
-        logdebug("Enter GenerateOnAllChildSuccess: %s" % parentkey)
+class _OnAllChildSuccess(object):
+    """Combines the results of a future's children into its result, once they've all succeeded.
+
+    Normally this loads every child's result and folds them together with combineresultf, in order,
+    when the last child finishes. If incremental is True, each child's result is instead folded into
+    one of several accumulator entities (in the transaction that sets the child's success), and only
+    those are combined at the end. That spreads the work across the children, but results are combined
+    in no particular order, so combineresultf must be associative and commutative (like the default,
+    addition).
+    """
+
+    def __init__(self, parentkey, initialvalue, combineresultf, failonerror=True, incremental=False):
+        self.parentkey = parentkey
+        self.initialvalue = initialvalue
+        self.combineresultf = combineresultf
+        self.failonerror = failonerror
+        self.incremental = incremental
+
+    def accumulate(self, result, storedrefsers):
+        """Folds a child's result into a random accumulator. Must be called in a transaction.
+
+        If combining fails, the error is kept in the accumulator rather than raised, so the child's
+        success still commits, and the parent fails with it once all the children are done.
+
+        A big value is written to the result store before the transaction commits, so its ref is
+        added to storedrefsers, for the caller to delete if the transaction doesn't commit.
+        """
+        key = random.choice(_accumulator_keys(self.parentkey))
+        accumulator = key.get() or _FutureAccumulator(key=key)
+        if accumulator.errorser:
+            return
+        oldrefser = accumulator.valuerefser
+        try:
+            if accumulator.valueser or accumulator.valuerefser:
+                value = self.combineresultf(_deserialize_result(accumulator.valueser, accumulator.valuerefser), result)
+            else:
+                value = result
+            accumulator.valueser, accumulator.valuerefser = _serialize_result(value)
+            if accumulator.valuerefser:
+                storedrefsers.append(accumulator.valuerefser)
+        except Exception, ex:
+            logexception("combining result in accumulator %s failed", key)
+            accumulator.errorser = cloudpickle.dumps(ex)
+        accumulator.put()
+        if oldrefser and oldrefser != accumulator.valuerefser:
+            ndb.get_context().call_on_commit(lambda: _delete_stored_result(oldrefser))
+
+    def _combine_accumulators(self):
+        """Returns (combined result, None), or (None, error) if combining failed."""
+        result = self.initialvalue
+        for accumulator in ndb.get_multi(_accumulator_keys(self.parentkey)):
+            if accumulator and accumulator.errorser:
+                return None, pickle.loads(accumulator.errorser)
+            if accumulator and (accumulator.valueser or accumulator.valuerefser):
+                try:
+                    result = self.combineresultf(result, _deserialize_result(accumulator.valueser,
+                                                                             accumulator.valuerefser))
+                except Exception, ex:
+                    return None, ex
+        return result, None
+
+    def __call__(self):
+        parentkey = self.parentkey
+        logdebug("Enter GenerateOnAllChildSuccess: %s", parentkey)
         parentfuture = parentkey.get() if parentkey else None
         if parentfuture and not parentfuture.has_result():
             if not parentfuture.initialised or not parentfuture.readyforresult:
                 raise Exception("Parent not initialised, retry")
 
+            if not parentfuture._all_children_succeeded():
+                logdebug("children not finished in OnAllChildSuccess, skipping")
+                return
+
+            if self.incremental and parentfuture.countschildren:
+                result, error = self._combine_accumulators()
+                if error:
+                    logwarning("Internal error, combining results failed in OnAllChildSuccess: %s", error)
+                    if self.failonerror:
+                        parentfuture.set_failure(error)
+                        return
+                    raise error
+                logdebug("result: %s", result)
+                parentfuture.set_success(result)
+                return
+
             @ndb.transactional()
             def get_children_trans():
                 return get_children(parentfuture.key)
 
             children = get_children_trans()
 
-            logdebug("children: %s" % [child.key for child in children])
+            if parentfuture.countschildren:
+                childcount, = _get_counters(parentkey, "children")
+                if len(children) < childcount:
+                    # the flat layout's children query can be behind
+                    raise Exception("only found %s of %s children, retry" % (len(children), childcount))
+
+            logdebug("children: %s", [child.key for child in children])
             if children:
-                result = initialvalue
+                result = self.initialvalue
                 error = None
                 finished = True
                 for childfuture in children:
-                    logdebug("childfuture: %s" % childfuture.key)
+                    logdebug("childfuture: %s", childfuture.key)
                     if childfuture.has_result():
                         try:
                             childresult = childfuture.get_result()
-                            logdebug("childresult(%s): %s" % (childfuture.status, childresult))
-                            result = combineresultf(result, childresult)
-                            logdebug("hasresult:%s" % result)
+                            logdebug("childresult(%s): %s", childfuture.status, childresult)
+                            result = self.combineresultf(result, childresult)
+                            logdebug("hasresult:%s", result)
                         except Exception, ex:
-                            logdebug("haserror:%s" % repr(ex))
+                            logdebug("haserror:%s", repr(ex))
                             error = ex
                             break
                     else:
@@ -500,13 +914,13 @@ def GenerateOnAllChildSuccess(parentkey, initialvalue, combineresultf, failonerr
                         finished = False
 
                 if error:
-                    logwarning("Internal error, child has error in OnAllChildSuccess: %s" % error)
-                    if failonerror:
+                    logwarning("Internal error, child has error in OnAllChildSuccess: %s", error)
+                    if self.failonerror:
                         parentfuture.set_failure(error)
                     else:
                         raise error
                 elif finished:
-                    logdebug("result: %s" % result)
+                    logdebug("result: %s", result)
                     parentfuture.set_success(result)  # (result, initialamount, keyrange))
                 else:
                     logdebug("child not finished in OnAllChildSuccess, skipping")
@@ -514,29 +928,65 @@ def GenerateOnAllChildSuccess(parentkey, initialvalue, combineresultf, failonerr
                 logwarning("Internal error, parent has no children in OnAllChildSuccess")
                 parentfuture.set_failure(Exception("no children found"))
 
-    return OnAllChildSuccess
 
+def GenerateOnAllChildSuccess(parentkey, initialvalue, combineresultf, failonerror=True, incremental=False):
+    return _OnAllChildSuccess(parentkey, initialvalue, combineresultf, failonerror, incremental)
+
+
+def generatefuturepagemapf(mapf, initialresult=None, oncombineresultsf=None, incremental=False, leafsize=None,
+                           peritemfutures=False, usepool=False, poolargs=None, **taskkwargs):
+    """Returns a pagemapf that calls mapf(futurekey, item) for each item in a page, and combines the results.
+
+    The page is split in half, in child futures, until there are at most leafsize items. Those leaf
+    futures then call mapf for each of their items in turn, in one task, and combine the results
+    themselves, so if one item fails the whole leaf is retried, and mapf has to cope with seeing an
+    item again. If peritemfutures is True, leaves make a child future for each item instead, so mapf
+    gets its own future and retries, at the cost of an entity and a task per item.
+
+    Args:
+      leafsize: Most items for a leaf. Defaults to 100, or 5 with peritemfutures.
+      usepool: If True, mapf is called as mapf(futurekey, item, pool=pool), with a MutationPool
+        shared by the leaf's items and flushed when they're all done.
+      poolargs: Keyword arguments for the MutationPool.
+    """
+    lleafsize = leafsize if leafsize else (5 if peritemfutures else 100)
+
+    if usepool:
+        def mapitemf(futurekey, item):
+            with MutationPool(**(poolargs or {})) as pool:
+                return mapf(futurekey, item, pool=pool)
+    else:
+        mapitemf = mapf
 
-def generatefuturepagemapf(mapf, initialresult=None, oncombineresultsf=None, **taskkwargs):
     def futurepagemapf(futurekey, items):
         linitialresult = initialresult or 0
         loncombineresultsf = oncombineresultsf if oncombineresultsf else lambda a, b: a + b
 
+        if not peritemfutures and len(items) <= lleafsize:
+            # exceptions escape, so the whole leaf is retried
+            result = linitialresult
+            if usepool:
+                with MutationPool(**(poolargs or {})) as pool:
+                    for item in items:
+                        result = loncombineresultsf(result, mapf(futurekey, item, pool=pool))
+            else:
+                for item in items:
+                    result = loncombineresultsf(result, mapf(futurekey, item))
+            return result
+
         try:
-            lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf)
+            lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf,
+                                                            incremental=incremental)
 
-            if len(items) > 5:
+            if len(items) > lleafsize:
                 leftitems = items[len(items) / 2:]
                 rightitems = items[:len(items) / 2]
-                future(futurepagemapf, parentkey=futurekey, futurename="split left %s" % len(leftitems),
-                       onallchildsuccessf=lonallchildsuccessf, weight=len(leftitems), **taskkwargs)(leftitems)
-                future(futurepagemapf, parentkey=futurekey, futurename="split right %s" % len(rightitems),
-                       onallchildsuccessf=lonallchildsuccessf, weight=len(rightitems), **taskkwargs)(rightitems)
+                future_many(futurepagemapf, [(leftitems,), (rightitems,)], parentkey=futurekey,
+                            futurenameprefix="split", onallchildsuccessf=lonallchildsuccessf,
+                            weight=[len(leftitems), len(rightitems)], **taskkwargs)
             else:
-                for index, item in enumerate(items):
-                    futurename = "ProcessItem %s" % index
-                    future(mapf, parentkey=futurekey, futurename=futurename, onallchildsuccessf=lonallchildsuccessf,
-                           weight=1, **taskkwargs)(item)
+                future_many(mapitemf, [(item,) for item in items], parentkey=futurekey, futurenameprefix="ProcessItem",
+                            onallchildsuccessf=lonallchildsuccessf, weight=1, **taskkwargs)
         except Exception, ex:
             raise PermanentTaskFailure(repr(ex))
         else:
@@ -550,31 +1000,121 @@ def OnProgressF(futurekey):
     if futureobj.parentkey:
         taskkwargs = futureobj.get_taskkwargs()
 
-        logdebug("Enter OnProgressF: %s" % futureobj)
+        logdebug("Enter OnProgressF: %s", futureobj)
 
         @task(**taskkwargs)
         def UpdateParent(parentkey):
             logdebug("***************************************************")
-            logdebug("Enter UpdateParent: %s" % parentkey)
+            logdebug("Enter UpdateParent: %s", parentkey)
             logdebug("***************************************************")
 
             parent = parentkey.get()
-            logdebug("1: %s" % parent)
+            logdebug("1: %s", parent)
             if parent:
                 logdebug("2")
                 #                 if not parent.has_result():
                 progress = 0
                 for childfuture in get_children(parentkey):
-                    logdebug("3: %s" % childfuture)
+                    logdebug("3: %s", childfuture)
                     progress += childfuture.get_progress()
-                logdebug("4: %s" % progress)
+                logdebug("4: %s", progress)
                 parent.set_progress(progress)
 
         UpdateParent(futureobj.parentkey)
 
 
+@ndb.non_transactional()
+def _get_flat_children(futurekey):
+    # not an ancestor query, so it's eventually consistent. Anything that needs to see every child
+    # should check how many it got against the future's children counter.
+    return _Future.query(_Future.parentkey == futurekey).order(_Future.stored).fetch()
+
+
+def _get_children_async(futurekey, pagesize=None, cursor=None):
+    """Starts loading a future's children. Returns a future for (children, cursor for the rest or None).
+
+    Queries on parentkey in both layouts: in the nested one an ancestor query would also find the
+    grandchildren, so pages would come up short and the cursor would walk the whole subtree.
+    """
+    query = _Future.query(_Future.parentkey == futurekey).order(_Future.stored)
+
+    @ndb.tasklet
+    def load():
+        if pagesize:
+            children, nextcursor, more = yield query.fetch_page_async(pagesize, start_cursor=cursor)
+        else:
+            children, nextcursor, more = (yield query.fetch_async()), None, False
+        raise ndb.Return(children, nextcursor if more else None)
+
+    return load()
+
+
+def _get_childcounts(futures):
+    """Returns how many children each future has, from the counters, or None for futures that don't count them."""
+    counted = [futureobj for futureobj in futures if futureobj.countschildren]
+    counters = ndb.get_multi([key for futureobj in counted for key in _counter_keys(futureobj.key, "children")])
+    counts = {}
+    for index, futureobj in enumerate(counted):
+        shards = counters[index * _COUNTER_SHARDS:(index + 1) * _COUNTER_SHARDS]
+        counts[futureobj.key] = sum(counter.count for counter in shards if counter)
+    return [counts.get(futureobj.key) for futureobj in futures]
+
+
+def load_futuretree(futures, level=0, max_level=5, future_map_fn=None, pagesize=None, cursor=None):
+    """Returns to_dict style dicts for some futures and their descendants, down to max_level.
+
+    Loads the tree a level at a time: the children of every future on a level are queried at once,
+    and their progress (from memcache where possible) and child counts are loaded in bulk. So this
+    takes a few RPCs per level rather than several per future.
+
+    Args:
+      futures: The futures to start from, all on the same level.
+      pagesize: If given, include at most this many children of each future, and put a cursor for
+        the rest in the future's "zchildrencursor".
+      cursor: Where to start the children of the first future, from its "zchildrencursor".
+    """
+    if isinstance(cursor, basestring):
+        cursor = ndb.Cursor(urlsafe=cursor)
+    rootdicts = []
+    current = [(futureobj, rootdicts) for futureobj in futures]
+    while current:
+        levelfutures = [futureobj for futureobj, _ in current]
+        progresses = get_futureprogress_multi([futureobj.key for futureobj in levelfutures])
+        childcounts = _get_childcounts(levelfutures)
+
+        nodes = []
+        for (futureobj, siblings), progress, childcount in zip(current, progresses, childcounts):
+            node = futureobj._to_dict_node(level, future_map_fn, progress, childcount)
+            siblings.append(node)
+            nodes.append(node)
+
+        if level + 1 >= max_level:
+            break
+
+        childfutures = [
+            _get_children_async(futureobj.key, pagesize, cursor if index == 0 else None)
+            for index, futureobj in enumerate(levelfutures)
+        ]
+        # the cursor is only for the first level's children
+        cursor = None
+        current = []
+        for node, childfuture in zip(nodes, childfutures):
+            children, nextcursor = childfuture.get_result()
+            node["zchildren"] = []
+            if nextcursor:
+                node["zchildrencursor"] = nextcursor.urlsafe()
+            if node["childcount"] is None and not nextcursor:
+                node["childcount"] = len(children)
+            current.extend((child, node["zchildren"]) for child in children)
+        level += 1
+
+    return rootdicts
+
+
 def get_children(futurekey):
-    if futurekey:
+    if futurekey and _is_flat(futurekey):
+        return _get_flat_children(futurekey)
+    elif futurekey:
         ancestorkey = ndb.Key(futurekey.kind(), futurekey.id())
         return [childfuture for childfuture in _Future.query(ancestor=ancestorkey).order(_Future.stored) if
                 ancestorkey == childfuture.key.parent()]
@@ -598,21 +1138,168 @@ def all_children_success(futurekey):
     return retval
 
 
-def setlocalprogress(futurekey, value):
-    future = futurekey.get() if futurekey else None
-    if future:
-        future.set_localprogress(value)
+def _flush_localprogress_later(futurekey, taskkwargs=None):
+    def flushlocalprogress():
+        futureobj = futurekey.get()
+        value = memcache.get("%s%s" % (_LOCALPROGRESS_CACHE_PREFIX, futurekey.id()))
+        # once the future is done its progress has been set for good
+        if futureobj and not futureobj.has_result() and value is not None:
+            futureobj.set_localprogress(value)
+
+    def gettaskkwargs():
+        if taskkwargs is not None:
+            # the mappers pass the kwargs they give future()
+            return get_taskonlykwargs(taskkwargs)
+        futureobj = futurekey.get()
+        return futureobj.get_taskkwargs() if futureobj else {}
+
+    _addtask_debounced(futurekey, gettaskkwargs, "flushprogress", flushlocalprogress, (), {})
+
+
+def setlocalprogress(futurekey, value, taskkwargs=None):
+    """Sets a future's local progress.
+
+    The value goes to memcache, where get_futureprogress sees it straight away, and is written to the
+    datastore by a debounced task, so it's fine to call this often: most calls are just memcache calls.
+
+    Args:
+      taskkwargs: The future's task arguments, for the debounced task. If not given they're read
+        from the future, once an interval.
+    """
+    if futurekey:
+        memcache.set("%s%s" % (_LOCALPROGRESS_CACHE_PREFIX, futurekey.id()), value, time=_CACHE_EXPIRESEC)
+        _flush_localprogress_later(futurekey, taskkwargs)
+
+
+def addlocalprogress(futurekey, delta, taskkwargs=None):
+    """Adds delta to a future's local progress, atomically. Like setlocalprogress, it's written to the datastore later.
+
+    delta can be negative, but progress doesn't go below 0.
+    """
+    if futurekey:
+        cachekey = "%s%s" % (_LOCALPROGRESS_CACHE_PREFIX, futurekey.id())
+
+        def addtocached():
+            # incr only takes non-negative deltas
+            return memcache.incr(cachekey, delta) if delta >= 0 else memcache.decr(cachekey, -delta)
+
+        if addtocached() is None:
+            # not cached, so start from what's in the datastore
+            localprogress = _progress_dict(ndb.Key(_FutureProgress, futurekey.id()).get())["localprogress"]
+            if not memcache.add(cachekey, max(localprogress + delta, 0), time=_CACHE_EXPIRESEC):
+                addtocached()
+        _flush_localprogress_later(futurekey, taskkwargs)
+
+
+def get_futureprogress(futurekey):
+    """Returns a future's progress, as a dict of localprogress, calculatedprogress and weight.
+
+    Reads memcache first, so it's cheap to poll. Local progress set with setlocalprogress or
+    addlocalprogress shows up here before it's written to the datastore.
+    """
+    return get_futureprogress_multi([futurekey])[0]
+
+
+def get_futureprogress_multi(futurekeys):
+    """Like get_futureprogress, for many futures at once."""
+    progresscachekeys = ["%s%s" % (_PROGRESS_CACHE_PREFIX, futurekey.id()) for futurekey in futurekeys]
+    localcachekeys = ["%s%s" % (_LOCALPROGRESS_CACHE_PREFIX, futurekey.id()) for futurekey in futurekeys]
+    cached = memcache.get_multi(progresscachekeys + localcachekeys)
+
+    missing = [index for index, cachekey in enumerate(progresscachekeys) if cached.get(cachekey) is None]
+    if missing:
+        progressobjs = ndb.get_multi([ndb.Key(_FutureProgress, futurekeys[index].id()) for index in missing])
+        loaded = dict((progresscachekeys[index], _progress_dict(progressobj))
+                      for index, progressobj in zip(missing, progressobjs))
+        # add rather than set, so this can't overwrite a newer value
+        memcache.add_multi(loaded, time=_PROGRESS_CACHE_EXPIRESEC)
+        cached.update(loaded)
+
+    progresses = []
+    for progresscachekey, localcachekey in zip(progresscachekeys, localcachekeys):
+        progress = cached[progresscachekey]
+        localprogress = cached.get(localcachekey)
+        if localprogress is not None and localprogress != progress["localprogress"]:
+            progress = dict(progress, localprogress=localprogress,
+                            calculatedprogress=max(progress["calculatedprogress"], localprogress))
+        progresses.append(progress)
+    return progresses
+
+
+def get_futurestatus(futurekey):
+    """Returns a future's status, "success" or "failure", or None if it's still underway. Reads memcache first."""
+    cachekey = "%s%s" % (_STATUS_CACHE_PREFIX, futurekey.id())
+    status = memcache.get(cachekey)
+    if status is None:
+        futureobj = futurekey.get()
+        status = futureobj.status if futureobj and futureobj.status else ""
+        memcache.add(cachekey, status, time=_CACHE_EXPIRESEC)
+    return status or None
 
 
 def GenerateStableId(instring):
     return hashlib.md5(instring).hexdigest()
 
 
+def _run_future(futurekey, f, args, kwargs, weight, maxretries, headers):
+    """Runs a future's function, in the future's task, and updates the future with the outcome."""
+    if maxretries:
+        lretryCount = 0
+        try:
+            lretryCount = int(headers.get("X-Appengine-Taskretrycount", 0)) if headers else 0
+        except:
+            logexception("Failed trying to get retry count, using 0")
+
+        if lretryCount > maxretries:
+            raise PermanentTaskFailure("Too many retries of Future")
+
+    logdebug("inner, futurekey=%s", futurekey)
+    futureobj2 = futurekey.get()
+    if futureobj2:
+        futureobj2.set_weight(weight)  # if weight >= 1 else 1)
+    else:
+        raise Exception("Future not ready yet")
+
+    try:
+        logdebug("args, kwargs=%s, %s", args, kwargs)
+        result = f(futurekey, *args, **kwargs)
+
+    except FutureReadyForResult:
+        futureobj3 = futurekey.get()
+        if futureobj3:
+            futureobj3.set_readyforesult()
+
+    except FutureNotReadyForResult:
+        futureobj4 = futurekey.get()
+        if futureobj4:
+            futureobj4.set_initialised()
+
+    except PermanentTaskFailure, ptf:
+        try:
+            futureobj5 = futurekey.get()
+            if futureobj5:
+                futureobj5.set_failure(ptf)
+        finally:
+            raise ptf
+    else:
+        futureobj6 = futurekey.get()
+        if futureobj6:
+            futureobj6.set_success_and_readyforesult(result)
+
+
 def future(f=None, parentkey=None,
            onsuccessf=None, onfailuref=None,
            onallchildsuccessf=None,
            onprogressf=None,
-           weight=None, timeoutsec=1800, maxretries=None, futurename=None, **taskkwargs):
+           weight=None, timeoutsec=1800, maxretries=None, futurename=None, flat=False, **taskkwargs):
+    """Runs f(futurekey, *args, **kwargs) in a task, tracked by a _Future entity.
+
+    By default a child future's key has its parent as its ancestor, so all the children of a future
+    are in one entity group, and creating them or changing their status is limited by that group's
+    write rate. With flat=True, futures have root level keys instead, and their children are found
+    by querying on parentkey. Children always use the same layout as their parent, so flat only
+    matters for top level futures.
+    """
     if not f:
         return functools.partial(future,
                                  parentkey=parentkey,
@@ -620,7 +1307,7 @@ def future(f=None, parentkey=None,
                                  onallchildsuccessf=onallchildsuccessf,
                                  onprogressf=onprogressf,
                                  weight=weight, timeoutsec=timeoutsec, maxretries=maxretries, futurename=futurename,
-                                 **taskkwargs)
+                                 flat=flat, **taskkwargs)
 
     #     logdebug("includefuturekey: %s" % includefuturekey)
 
@@ -628,7 +1315,7 @@ def future(f=None, parentkey=None,
     def runfuture(*args, **kwargs):
         @ndb.transactional(xg=True)
         def runfuturetrans():
-            logdebug("runfuture: parentkey=%s" % parentkey)
+            logdebug("runfuture: parentkey=%s", parentkey)
 
             immediateancestorkey = ndb.Key(parentkey.kind(), parentkey.id()) if parentkey else None
 
@@ -646,7 +1333,11 @@ def future(f=None, parentkey=None,
                 taskkwargscopy["transactional"] = False
                 newfutureId = GenerateStableId(taskkwargs["name"])
 
-            newkey = ndb.Key(_Future, newfutureId, parent=immediateancestorkey)
+            if _is_flat(parentkey) if parentkey else flat:
+                # ids are uuids or hashes, so flat keys are spread evenly over the key space
+                newkey = ndb.Key(_Future, _FLAT_ID_PREFIX + newfutureId)
+            else:
+                newkey = ndb.Key(_Future, newfutureId, parent=immediateancestorkey)
 
             #         logdebug("runfuture: ancestorkey=%s" % immediateancestorkey)
             #         logdebug("runfuture: newkey=%s" % newkey)
@@ -678,61 +1369,31 @@ def future(f=None, parentkey=None,
 
             futureobj.name = futurename
 
-            futureobj.put()
+            futureobj.countschildren = True
+
+            # a named future is created again if its caller is retried, but mustn't be counted again
+            isnew = "name" not in taskkwargs or not newkey.get()
+
+            # the key is already known, so the put can overlap with the enqueue below
+            putfuture = futureobj.put_async()
+            if parentkey and isnew:
+                _increment_counter(parentkey, "children")
             #         logdebug("runfuture: childkey=%s" % futureobj.key)
 
             futurekey = futureobj.key
-            logdebug("outer, futurekey=%s" % futurekey)
+            logdebug("outer, futurekey=%s", futurekey)
 
             @task(includeheaders=True, **taskkwargscopy)
             def _futurewrapper(headers):
-                if maxretries:
-                    lretryCount = 0
-                    try:
-                        lretryCount = int(headers.get("X-Appengine-Taskretrycount", 0)) if headers else 0
-                    except:
-                        logexception("Failed trying to get retry count, using 0")
-
-                    if lretryCount > maxretries:
-                        raise PermanentTaskFailure("Too many retries of Future")
-
-                logdebug("inner, futurekey=%s" % futurekey)
-                futureobj2 = futurekey.get()
-                if futureobj2:
-                    futureobj2.set_weight(weight)  # if weight >= 1 else 1)
-                else:
-                    raise Exception("Future not ready yet")
-
-                try:
-                    logdebug("args, kwargs=%s, %s" % (args, kwargs))
-                    result = f(futurekey, *args, **kwargs)
-
-                except FutureReadyForResult:
-                    futureobj3 = futurekey.get()
-                    if futureobj3:
-                        futureobj3.set_readyforesult()
-
-                except FutureNotReadyForResult:
-                    futureobj4 = futurekey.get()
-                    if futureobj4:
-                        futureobj4.set_initialised()
-
-                except PermanentTaskFailure, ptf:
-                    try:
-                        futureobj5 = futurekey.get()
-                        if futureobj5:
-                            futureobj5.set_failure(ptf)
-                    finally:
-                        raise ptf
-                else:
-                    futureobj6 = futurekey.get()
-                    if futureobj6:
-                        futureobj6.set_success_and_readyforesult(result)
+                _run_future(futurekey, f, args, kwargs, weight, maxretries, headers)
 
+            # both RPCs have to complete before the transaction commits
+            addrpc = _futurewrapper.add_async()
+            putfuture.get_result()
             try:
                 # run the wrapper task, and if it fails due to a name clash just skip it (it was already kicked off by an earlier
                 # attempt to construct this future).
-                _futurewrapper()
+                addrpc.get_result()
             except taskqueue.TombstonedTaskError:
                 logdebug("skip adding task (already been run)")
             except taskqueue.TaskAlreadyExistsError:
@@ -755,6 +1416,122 @@ def future(f=None, parentkey=None,
     return runfuture
 
 
+# futures per transaction in future_many. In the flat layout each one is its own entity group, and
+# there's also a counter shard, so this keeps within the 25 groups an xg transaction can touch.
+_MAX_FLAT_FUTURES_PER_PUT = 20
+_MAX_FUTURES_PER_PUT = 250
+
+
+def _add_named_tasks(tasks, queue):
+    """Adds named tasks in bulk, skipping any that have already been added."""
+    chunks = [tasks[index:index + _MAX_TASKS_PER_ADD] for index in range(0, len(tasks), _MAX_TASKS_PER_ADD)]
+    rpcs = []
+    for chunk in chunks:
+        try:
+            rpcs.append((chunk, _add_tasks_async(chunk, queue, False)))
+        except (taskqueue.TombstonedTaskError, taskqueue.TaskAlreadyExistsError):
+            rpcs.append((chunk, None))
+
+    for chunk, rpc in rpcs:
+        try:
+            if not rpc:
+                raise taskqueue.TaskAlreadyExistsError()
+            rpc.get_result()
+        except (taskqueue.TombstonedTaskError, taskqueue.TaskAlreadyExistsError):
+            # some of the chunk was added earlier; add the rest one at a time
+            for t in chunk:
+                if not t.was_enqueued:
+                    try:
+                        _add_task(t, queue, False)
+                    except (taskqueue.TombstonedTaskError, taskqueue.TaskAlreadyExistsError):
+                        logdebug("skip adding task %s (already added)", t.name)
+
+
+def future_many(f, argslist, parentkey=None, onsuccessf=None, onfailuref=None, onallchildsuccessf=None,
+                onprogressf=None, weight=None, timeoutsec=1800, maxretries=None, futurenameprefix=None, flat=False,
+                **taskkwargs):
+    """Creates a future for each item of argslist, like future(f, ...)(*args) for each one, but in bulk.
+
+    The futures are written with put_multi, the callbacks are pickled once for all of them, and their
+    tasks are added in batches. The tasks are named, and the futures have ids made from the parent,
+    futurenameprefix, index and arguments, so calling this again with the same arguments (eg: when the
+    calling task is retried) doesn't create anything twice. Give calls under the same parent different
+    futurenameprefixes.
+
+    Args:
+      argslist: A list of tuples of arguments for f, after the future key.
+      weight: A weight for every future, or a list with one for each.
+    Returns:
+      The futures, in the same order as argslist.
+    """
+    argslist = list(argslist)
+    if not argslist:
+        return []
+
+    weights = weight if isinstance(weight, (list, tuple)) else [weight] * len(argslist)
+    prefix = futurenameprefix if futurenameprefix else getattr(f, "__name__", "future")
+    isflat = _is_flat(parentkey) if parentkey else flat
+    immediateancestorkey = ndb.Key(parentkey.kind(), parentkey.id()) if parentkey else None
+
+    taskkwargs.pop("name", None)  # the tasks are named after the futures
+    taskkwargs.pop("futurename", None)
+    queue = taskkwargs.get("queue", "default")
+
+    keys = []
+    for index, args in enumerate(argslist):
+        if parentkey:
+            newfutureId = GenerateStableId("%s-%s-%s-%s" % (
+                parentkey.id(), prefix, index, hashlib.md5(cloudpickle.dumps(args)).hexdigest()))
+        else:
+            newfutureId = str(uuid.uuid4())
+        if isflat:
+            keys.append(ndb.Key(_Future, _FLAT_ID_PREFIX + newfutureId))
+        else:
+            keys.append(ndb.Key(_Future, newfutureId, parent=immediateancestorkey))
+
+    shared = {
+        "onsuccessfser": cloudpickle.dumps(onsuccessf) if onsuccessf else None,
+        "onfailurefser": cloudpickle.dumps(onfailuref) if onfailuref else None,
+        "onallchildsuccessfser": cloudpickle.dumps(onallchildsuccessf) if onallchildsuccessf else None,
+        "onprogressfser": cloudpickle.dumps(onprogressf) if onprogressf else None,
+        "taskkwargsser": cloudpickle.dumps(taskkwargs),
+        "timeoutsec": timeoutsec,
+        "countschildren": True
+    }
+    now = datetime.datetime.utcnow()
+
+    @ndb.transactional(xg=True)
+    def put_new_futures(chunkkeys, startindex):
+        # only count the ones that don't already exist, so retries don't count them again
+        futures = ndb.get_multi(chunkkeys)
+        newfutures = [
+            _Future(key=key, parentkey=parentkey, name="%s [%s]" % (prefix, startindex + index),
+                    # keeps them in order in get_children
+                    stored=now + datetime.timedelta(microseconds=startindex + index), **shared)
+            for index, (key, futureobj) in enumerate(zip(chunkkeys, futures)) if not futureobj
+        ]
+        if newfutures:
+            ndb.put_multi(newfutures)
+            if parentkey:
+                _increment_counter(parentkey, "children", len(newfutures))
+
+    perput = _MAX_FLAT_FUTURES_PER_PUT if isflat else _MAX_FUTURES_PER_PUT
+    for index in range(0, len(keys), perput):
+        put_new_futures(keys[index:index + perput], index)
+
+    # the function is stored once, and each task just refers to it
+    @task(includeheaders=True, cachefunction=True, **dict(taskkwargs, transactional=False))
+    def _futurewrapper(futurekey, args, futureweight, headers):
+        _run_future(futurekey, f, args, {}, futureweight, maxretries, headers)
+
+    tasks = []
+    for key, args, futureweight in zip(keys, argslist, weights):
+        tasks.append(_futurewrapper.make_task((key, args, futureweight), name="future-%s" % key.id()))
+    _add_named_tasks(tasks, queue)
+
+    return ndb.get_multi(keys)
+
+
 def GetFutureAndCheckReady(futurekey):
     futureobj = futurekey.get() if futurekey else None
     if not (futureobj and futureobj.initialised and futureobj.readyforresult):
@@ -766,7 +1543,7 @@ def GetFutureAndCheckReady(futurekey):
 # different from future function because it has a "results" argument, a list.
 def futuresequence(fsfseq, parentkey=None, onsuccessf=None, onfailuref=None, onallchildsuccessf=None, onprogressf=None,
                    weight=None, timeoutsec=1800, maxretries=None, futurenameprefix=None, **taskkwargs):
-    logdebug("Enter futuresequence: %s" % len(fsfseq))
+    logdebug("Enter futuresequence: %s", len(fsfseq))
 
     flist = list(fsfseq)
 
@@ -775,14 +1552,14 @@ def futuresequence(fsfseq, parentkey=None, onsuccessf=None, onfailuref=None, ona
     @future(parentkey=parentkey, onsuccessf=onsuccessf, onfailuref=onfailuref, onallchildsuccessf=onallchildsuccessf,
             onprogressf=onprogressf, weight=weight, timeoutsec=timeoutsec, maxretries=maxretries, **taskkwargs)
     def toplevel(futurekey, *args, **kwargs):
-        logdebug("Enter futuresequence.toplevel: %s" % futurekey)
+        logdebug("Enter futuresequence.toplevel: %s", futurekey)
 
         def childonsuccessforindex(index, results):
-            logdebug("Enter childonsuccessforindex: %s, %s, %s" % (futurekey, index, json.dumps(results, indent=2)))
+            logdebug(lambda: "Enter childonsuccessforindex: %s, %s, %s" % (futurekey, index, json.dumps(results, indent=2)))
 
             def childonsuccess(childfuturekey):
-                logdebug("Enter childonsuccess: %s, %s, %s" % (futurekey, index, childfuturekey))
-                logdebug("results: %s" % json.dumps(results, indent=2))
+                logdebug("Enter childonsuccess: %s, %s, %s", futurekey, index, childfuturekey)
+                logdebug(lambda: "results: %s" % json.dumps(results, indent=2))
                 try:
                     childfuture = GetFutureAndCheckReady(childfuturekey)
 
@@ -795,7 +1572,7 @@ def futuresequence(fsfseq, parentkey=None, onsuccessf=None, onfailuref=None, ona
                         else:
                             raise Exception("Can't load toplevel future for failure")
                     else:
-                        logdebug("result: %s" % json.dumps(result, indent=2))
+                        logdebug(lambda: "result: %s" % json.dumps(result, indent=2))
                         newresults = results + [result]
                         islast = (index == (len(flist) - 1))
 
@@ -816,9 +1593,9 @@ def futuresequence(fsfseq, parentkey=None, onsuccessf=None, onfailuref=None, ona
                                    weight=weight / len(flist) if weight else None, timeoutsec=timeoutsec,
                                    maxretries=maxretries, **taskkwargs)(newresults)
                 finally:
-                    logdebug("Enter childonsuccess: %s, %s, %s" % (futurekey, index, childfuturekey))
+                    logdebug("Enter childonsuccess: %s, %s, %s", futurekey, index, childfuturekey)
 
-            logdebug("Leave childonsuccessforindex: %s, %s, %s" % (futurekey, index, json.dumps(results, indent=2)))
+            logdebug(lambda: "Leave childonsuccessforindex: %s, %s, %s" % (futurekey, index, json.dumps(results, indent=2)))
             return childonsuccess
 
         taskkwargs["futurename"] = "%s [0]" % (futurenameprefix if futurenameprefix else "sequence")
@@ -826,7 +1603,7 @@ def futuresequence(fsfseq, parentkey=None, onsuccessf=None, onfailuref=None, ona
                weight=weight / len(flist) if weight else None, timeoutsec=timeoutsec, maxretries=maxretries,
                **taskkwargs)([])  # empty list of results
 
-        logdebug("Leave futuresequence.toplevel: %s" % futurekey)
+        logdebug("Leave futuresequence.toplevel: %s", futurekey)
         raise FutureNotReadyForResult("sequence started")
 
     return toplevel
@@ -834,7 +1611,7 @@ def futuresequence(fsfseq, parentkey=None, onsuccessf=None, onfailuref=None, ona
 
 def futureparallel(ffseq, parentkey=None, onsuccessf=None, onfailuref=None, onallchildsuccessf=None, onprogressf=None,
                    weight=None, timeoutsec=1800, maxretries=None, futurenameprefix=None, **taskkwargs):
-    logdebug("Enter futureparallel: %s" % len(ffseq))
+    logdebug("Enter futureparallel: %s", len(ffseq))
     flist = list(ffseq)
 
     taskkwargs["futurename"] = "%s (top level)" % futurenameprefix if futurenameprefix else "parallel"
@@ -842,61 +1619,19 @@ def futureparallel(ffseq, parentkey=None, onsuccessf=None, onfailuref=None, onal
     @future(parentkey=parentkey, onsuccessf=onsuccessf, onfailuref=onfailuref, onallchildsuccessf=onallchildsuccessf,
             onprogressf=onprogressf, weight=weight, timeoutsec=timeoutsec, maxretries=maxretries, **taskkwargs)
     def toplevel(futurekey, *args, **kwargs):
-        logdebug("Enter futureparallel.toplevel: %s" % futurekey)
-
-        def OnAllChildSuccess():
-            logdebug("Enter OnAllChildSuccess: %s" % futurekey)
-            parentfuture = futurekey.get() if futurekey else None
-            if parentfuture and not parentfuture.has_result():
-                if not parentfuture.initialised or not parentfuture.readyforresult:
-                    raise Exception("Parent not initialised, retry")
-
-                @ndb.transactional()
-                def get_children_trans():
-                    return get_children(parentfuture.key)
-
-                children = get_children_trans()
-
-                logdebug("children: %s" % [child.key for child in children])
-                if children:
-                    result = []
-                    error = None
-                    finished = True
-                    for childfuture in children:
-                        logdebug("childfuture: %s" % childfuture.key)
-                        if childfuture.has_result():
-                            try:
-                                childresult = childfuture.get_result()
-                                logdebug("childresult(%s): %s" % (childfuture.status, childresult))
-                                result += [childfuture.get_result()]
-                                logdebug("intermediate result:%s" % result)
-                            except Exception, ex:
-                                logdebug("haserror:%s" % repr(ex))
-                                error = ex
-                                break
-                        else:
-                            logdebug("noresult")
-                            finished = False
+        logdebug("Enter futureparallel.toplevel: %s", futurekey)
 
-                    if error:
-                        logwarning("Internal error, child has error in OnAllChildSuccess: %s" % error)
-                        parentfuture.set_failure(error)
-                    elif finished:
-                        logdebug("result: %s" % result)
-                        parentfuture.set_success(result)
-                    else:
-                        logdebug("child not finished in OnAllChildSuccess, skipping")
-                else:
-                    logwarning("Internal error, parent has no children in OnAllChildSuccess")
-                    parentfuture.set_failure(Exception("no children found"))
+        OnAllChildSuccess = GenerateOnAllChildSuccess(futurekey, [], lambda a, b: a + [b])
+
+        def RunIndex(childfuturekey, ix):
+            return flist[ix](childfuturekey)
 
-        for ix, ff in enumerate(flist):
-            taskkwargs["futurename"] = "%s [%s]" % (futurenameprefix if futurenameprefix else "parallel", ix)
-            future(ff, parentkey=futurekey, onallchildsuccessf=OnAllChildSuccess,
-                   weight=weight / len(flist) if weight else None, timeoutsec=timeoutsec, maxretries=maxretries,
-                   **taskkwargs)()
+        future_many(RunIndex, [(ix,) for ix in range(len(flist))], parentkey=futurekey,
+                    futurenameprefix=futurenameprefix if futurenameprefix else "parallel",
+                    onallchildsuccessf=OnAllChildSuccess, weight=weight / len(flist) if weight else None,
+                    timeoutsec=timeoutsec, maxretries=maxretries, **taskkwargs)
 
-        logdebug("Leave futureparallel.toplevel: %s" % futurekey)
+        logdebug("Leave futureparallel.toplevel: %s", futurekey)
         raise FutureReadyForResult("parallel started")
 
     return toplevel
@@ -14,7 +14,7 @@ def gcscacher(f, bucketname=None, cachekey=None, expiresec=None):
 
     def getvalue(*args, **kwargs):
         key = cachekey if cachekey else make_flash(f, args, kwargs)
-        logdebug("Enter gcscacher.getvalue: %s" % key)
+        logdebug("Enter gcscacher.getvalue: %s", key)
 
         bucket = bucketname if bucketname else os.environ.get(
             'BUCKET_NAME',
@@ -22,7 +22,7 @@ def gcscacher(f, bucketname=None, cachekey=None, expiresec=None):
 
         lpicklepath = "/%s/gcscache/%s.pickle" % (bucket, key)
 
-        logdebug("picklepath: %s" % lpicklepath)
+        logdebug("picklepath: %s", lpicklepath)
 
         lsaved = None
         try:
@@ -52,7 +52,7 @@ def gcscacher(f, bucketname=None, cachekey=None, expiresec=None):
         else:
             logdebug("GCS Cache hit")
 
-        logdebug("Leave gcscacher.getvalue: %s" % key)
+        logdebug("Leave gcscacher.getvalue: %s", key)
 
         return lcontent
 
@@ -1,30 +1,31 @@
-from task import task
+from task import task, TaskBatch
 import cloudstorage as gcs
 from future import future, FutureReadyForResult, GenerateOnAllChildSuccess  # get_children
-from future import setlocalprogress, generatefuturepagemapf
+from future import setlocalprogress, generatefuturepagemapf, future_many
 from google.cloud import storage  # @UnresolvedImport
 from taskutils.future import GenerateStableId
 from google.appengine.ext.deferred.deferred import PermanentTaskFailure
-from taskutils.util import logdebug, logexception
+from taskutils.util import logdebug, logdebugsampled, logexception
 
 
 def gcsfileshardedpagemap(pagemapf=None, gcspath=None, initialshards=10, pagesize=100, **taskkwargs):
     @task(**taskkwargs)
     def MapOverRange(startpos, endpos, **kwargs):
-        logdebug("Enter MapOverRange: %s, %s" % (startpos, endpos))
+        logdebug("Enter MapOverRange: %s, %s", startpos, endpos)
 
         # open file at gcspath for read
         with gcs.open(gcspath) as gcsfile:
             page, ranges = hwalk(gcsfile, pagesize, initialshards, startpos, endpos)
 
         if ranges:
-            for arange in ranges:
-                MapOverRange(arange[0], arange[1])
+            with TaskBatch():
+                for arange in ranges:
+                    MapOverRange(arange[0], arange[1])
 
         if pagemapf:
             pagemapf(page)
 
-        logdebug("Leave MapOverRange: %s, %s" % (startpos, endpos))
+        logdebug("Leave MapOverRange: %s, %s", startpos, endpos)
 
     # get length of file in bytes
     filestat = gcs.stat(gcspath)
@@ -33,27 +34,31 @@ def gcsfileshardedpagemap(pagemapf=None, gcspath=None, initialshards=10, pagesiz
 
 
 def gcsfileshardedmap(mapf=None, gcspath=None, initialshards=10, pagesize=100, **taskkwargs):
-    @task(**taskkwargs)
+    invokemaptaskkwargs = dict(taskkwargs)
+    invokemaptaskkwargs.setdefault("cachefunction", True)
+
+    @task(**invokemaptaskkwargs)
     def InvokeMap(line, **kwargs):
-        logdebug("Enter InvokeMap: %s" % line)
+        logdebug("Enter InvokeMap: %s", line)
         try:
             mapf(line, **kwargs)
         finally:
-            logdebug("Leave InvokeMap: %s" % line)
+            logdebug("Leave InvokeMap: %s", line)
 
     def ProcessPage(lines):
-        for index, line in enumerate(lines):
-            logdebug("Line #%s: %s" % (index, line))
-            InvokeMap(line)
+        with TaskBatch():
+            for index, line in enumerate(lines):
+                logdebugsampled(0.01, "Line #%s: %s", index, line)
+                InvokeMap(line)
 
     gcsfileshardedpagemap(ProcessPage, gcspath, initialshards, pagesize, **taskkwargs)
 
 
 def futuregcsfileshardedpagemap(pagemapf=None, gcspath=None, pagesize=100, onsuccessf=None, onfailuref=None,
                                 onprogressf=None, onallchildsuccessf=None, initialresult=None, oncombineresultsf=None,
-                                weight=None, parentkey=None, **taskkwargs):
+                                weight=None, parentkey=None, incremental=False, **taskkwargs):
     def MapOverRange(futurekey, startbyte, endbyte, weight, **kwargs):
-        logdebug("Enter MapOverRange: %s, %s, %s" % (startbyte, endbyte, weight))
+        logdebug("Enter MapOverRange: %s, %s, %s", startbyte, endbyte, weight)
 
         linitialresult = initialresult if not initialresult is None else 0
         loncombineresultsf = oncombineresultsf if oncombineresultsf else lambda a, b: a + b
@@ -64,31 +69,31 @@ def futuregcsfileshardedpagemap(pagemapf=None, gcspath=None, pagesize=100, onsuc
                 page, ranges = hwalk(gcsfile, pagesize, 2, startbyte, endbyte)
 
             if pagemapf:
-                lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf)
+                lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf,
+                                                                incremental=incremental)
                 taskkwargs["futurename"] = "pagemap %s of %s,%s" % (len(page), startbyte, endbyte)
                 future(pagemapf, parentkey=futurekey, onallchildsuccessf=lonallchildsuccessf, weight=len(page),
                        **taskkwargs)(page)
             else:
-                setlocalprogress(futurekey, len(page))
+                setlocalprogress(futurekey, len(page), taskkwargs=taskkwargs)
 
             if ranges:
                 newweight = (weight - len(page)) / len(ranges) if not weight is None else None
-                for arange in ranges:
-                    taskkwargs["futurename"] = "shard %s" % arange
 
-                    lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey,
-                                                                    linitialresult if pagemapf else len(page),
-                                                                    loncombineresultsf)
+                lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey,
+                                                                linitialresult if pagemapf else len(page),
+                                                                loncombineresultsf, incremental=incremental)
 
-                    future(MapOverRange, parentkey=futurekey, onallchildsuccessf=lonallchildsuccessf, weight=newweight,
-                           **taskkwargs)(arange[0], arange[1], weight=newweight)
+                future_many(MapOverRange, [(arange[0], arange[1], newweight) for arange in ranges],
+                            parentkey=futurekey, futurenameprefix="shard", onallchildsuccessf=lonallchildsuccessf,
+                            weight=newweight, **taskkwargs)
 
             if ranges or pagemapf:
                 raise FutureReadyForResult("still going")
             else:
                 return len(page)
         finally:
-            logdebug("Leave MapOverRange: %s, %s, %s" % (startbyte, endbyte, weight))
+            logdebug("Leave MapOverRange: %s, %s, %s", startbyte, endbyte, weight)
 
     # get length of file in bytes
     filestat = gcs.stat(gcspath)
@@ -108,24 +113,25 @@ def futuregcsfileshardedpagemap(pagemapf=None, gcspath=None, pagesize=100, onsuc
 
 def generategcsinvokemapf(mapf):
     def InvokeMap(futurekey, line, **kwargs):
-        logdebug("Enter InvokeMap: %s" % line)
+        logdebug("Enter InvokeMap: %s", line)
         try:
             return mapf(line, **kwargs)
         finally:
-            logdebug("Leave InvokeMap: %s" % line)
+            logdebug("Leave InvokeMap: %s", line)
 
     return InvokeMap
 
 
 def futuregcsfileshardedmap(mapf=None, gcspath=None, pagesize=100, onsuccessf=None, onfailuref=None, onprogressf=None,
                             onallchildsuccessf=None, initialresult=None, oncombineresultsf=None, weight=None,
-                            parentkey=None, **taskkwargs):
+                            parentkey=None, incremental=False, leafsize=None, peritemfutures=False, **taskkwargs):
     invokeMapF = generategcsinvokemapf(mapf)
-    pageMapF = generatefuturepagemapf(invokeMapF, initialresult, oncombineresultsf ** taskkwargs)
+    pageMapF = generatefuturepagemapf(invokeMapF, initialresult, oncombineresultsf, incremental=incremental,
+                                      leafsize=leafsize, peritemfutures=peritemfutures, **taskkwargs)
     return futuregcsfileshardedpagemap(pageMapF, gcspath, pagesize, onsuccessf=onsuccessf, onfailuref=onfailuref,
                                        onprogressf=onprogressf, onallchildsuccessf=onallchildsuccessf,
                                        initialresult=initialresult, oncombineresultsf=oncombineresultsf,
-                                       parentkey=parentkey, weight=weight, **taskkwargs)
+                                       parentkey=parentkey, weight=weight, incremental=incremental, **taskkwargs)
 
 
 def futuregcscompose(gcsbucket=None, gcssourceprefix=None, gcstargetprefix=None, gcstargetfilename="output.txt",
@@ -137,7 +143,7 @@ def futuregcscompose(gcsbucket=None, gcssourceprefix=None, gcstargetprefix=None,
         return None
 
     def GCSCombineToTarget(futurekey, startindex, finishindex, istop, **kwargs):
-        logdebug("Enter GCSCombineToTarget: %s, %s" % (startindex, finishindex))
+        logdebug("Enter GCSCombineToTarget: %s, %s", startindex, finishindex)
         try:
             def higherlevelcompose(lop, rop):
                 try:
@@ -147,7 +153,7 @@ def futuregcscompose(gcsbucket=None, gcssourceprefix=None, gcstargetprefix=None,
                         blobs = getblobsbyname(gcsbucket, *blobnames)
                         if len(blobs) == 2:
                             ltotalcomponent_count = sum([blob.component_count for blob in blobs])
-                            logdebug("ltotalcomponent_count: %s" % ltotalcomponent_count)
+                            logdebug("ltotalcomponent_count: %s", ltotalcomponent_count)
                             if ltotalcomponent_count > 1020:
                                 logdebug("doing copying")
                                 newblobnames = ["%s-copy" % blobname for blobname in blobnames]
@@ -189,7 +195,7 @@ def futuregcscompose(gcsbucket=None, gcssourceprefix=None, gcstargetprefix=None,
 
             if numfiles > 32:
                 ranges = CalculateFileRanges(startindex, finishindex, 2)
-                logdebug("ranges:%s" % ranges)
+                logdebug("ranges:%s", ranges)
                 for r in ranges:
                     futurename = "split %s" % (r,)
                     future(GCSCombineToTarget, futurename=futurename, onallchildsuccessf=onallchildsuccessf,
@@ -203,7 +209,7 @@ def futuregcscompose(gcsbucket=None, gcssourceprefix=None, gcstargetprefix=None,
                 retval = composeblobs(gcsbucket, lfilename, lblobs)
                 return retval
         finally:
-            logdebug("Leave GCSCombineToTarget: %s, %s" % (startindex, finishindex))
+            logdebug("Leave GCSCombineToTarget: %s, %s", startindex, finishindex)
 
     futurename = "gcscombinetotarget %s" % numgcsfiles
 
@@ -14,11 +14,11 @@ def memcacher(f=None, cachekey=None, expiresec=600):
 
         retval = memcache.get(lcachekey)  # @UndefinedVariable
         if retval is None:
-            logdebug("MISS: %s" % lcachekey)
+            logdebug("MISS: %s", lcachekey)
             retval = f(*args, **kwargs)
             memcache.add(key=lcachekey, value=retval, time=expiresec)  # @UndefinedVariable
         else:
-            logdebug("HIT: %s" % lcachekey)
+            logdebug("HIT: %s", lcachekey)
 
         return retval
 
@@ -0,0 +1,147 @@
+"""
+Timing and size metrics for task(), fed to a sink set with taskutils.set_metricssink().
+
+Each measurement is recorded as (name, metric, value), where name is the task's logname (module/function
+by default) and metric is one of:
+
+  serializesec   time spent pickling (and compressing) a task's payload
+  payloadbytes   size of the payload, after compression
+  spillbytes     size of a payload that was too large for the task, and went to the spill store
+  datastorebytes size of a payload that was too large for the task, and went to the datastore
+  enqueuesec     time spent adding a task to its queue (tasks not added via a TaskBatch)
+  retrycount     the task's retry count, from its headers
+  unpicklesec    time spent unpickling a task's payload
+  execsec        time spent running the task's function
+  runsec         total time spent running the task, including loading it
+
+Nothing is measured when there's no sink, which is the default.
+"""
+
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+TASKUTILS_METRICSSINK = None
+
+
+def set_metricssink(value):
+    """Sets where task metrics go; None (the default) to not measure anything."""
+    global TASKUTILS_METRICSSINK
+    TASKUTILS_METRICSSINK = value
+
+
+def get_metricssink():
+    global TASKUTILS_METRICSSINK
+    return TASKUTILS_METRICSSINK
+
+
+def record(name, metric, value):
+    sink = get_metricssink()
+    if sink:
+        sink.record(name, metric, value)
+
+
+class InMemoryMetricsSink(object):
+    """Aggregates metrics in this process. Use get_stats() to read them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, metric, value):
+        with self._lock:
+            stats = self._stats.setdefault(name, {}).get(metric)
+            if stats is None:
+                self._stats[name][metric] = {"count": 1, "total": value, "min": value, "max": value}
+            else:
+                stats["count"] += 1
+                stats["total"] += value
+                stats["min"] = min(stats["min"], value)
+                stats["max"] = max(stats["max"], value)
+
+    def get_stats(self):
+        """Returns {name: {metric: {count, total, min, max, mean}}}."""
+        with self._lock:
+            return dict(
+                (name, dict(
+                    (metric, dict(stats, mean=float(stats["total"]) / stats["count"]))
+                    for metric, stats in metrics.items()))
+                for name, metrics in self._stats.items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class LogMetricsSink(object):
+    """Logs each metric as a line, for log based metrics or grepping."""
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def record(self, name, metric, value):
+        logging.log(self.level, "taskmetric %s %s=%s", name, metric, value)
+
+
+class MemcacheMetricsSink(object):
+    """Keeps count and total counters per name and metric in memcache, so they're shared across instances.
+
+    Counters are integers, so metrics measured in seconds are stored in milliseconds. Updates are
+    buffered in process, and sent with one memcache call every flushevery records or flushsec seconds.
+    Counters can be evicted, so treat them as a sample rather than an exact count.
+
+    Args:
+      prefix: Prefix for the memcache keys.
+    """
+
+    def __init__(self, prefix="taskmetrics", flushevery=100, flushsec=10):
+        self.prefix = prefix
+        self.flushevery = flushevery
+        self.flushsec = flushsec
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pendingcount = 0
+        self._lastflush = time.time()
+
+    def _key(self, name, metric, counter):
+        return "%s:%s:%s:%s" % (self.prefix, name, metric, counter)
+
+    def record(self, name, metric, value):
+        if metric.endswith("sec"):
+            value = int(round(value * 1000))
+        else:
+            value = int(value)
+        with self._lock:
+            countkey = self._key(name, metric, "count")
+            totalkey = self._key(name, metric, "total")
+            self._pending[countkey] = self._pending.get(countkey, 0) + 1
+            self._pending[totalkey] = self._pending.get(totalkey, 0) + value
+            self._pendingcount += 1
+            due = self._pendingcount >= self.flushevery or time.time() - self._lastflush >= self.flushsec
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Sends buffered updates to memcache."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pendingcount = 0
+            self._lastflush = time.time()
+        if pending:
+            memcache.offset_multi(pending, initial_value=0)
+
+    def get_stats(self, name, metrics):
+        """Returns {metric: {count, total}} for the given name and metrics, as currently held in memcache."""
+        keys = [self._key(name, metric, counter) for metric in metrics for counter in ("count", "total")]
+        values = memcache.get_multi(keys)
+        return dict(
+            (metric, {
+                "count": values.get(self._key(name, metric, "count"), 0),
+                "total": values.get(self._key(name, metric, "total"), 0)
+            })
+            for metric in metrics
+        )
@@ -0,0 +1,82 @@
+from google.appengine.ext import ndb
+
+from taskutils.util import logdebug
+
+
+class MutationPool(object):
+    """Buffers datastore puts and deletes, and writes them in batches.
+
+    Writes are sent with put_multi_async / delete_multi_async once maxcount entities or keys, or
+    maxbytes of them, are waiting, and whatever is left when the pool is flushed. Use it as a
+    context manager, which flushes and waits for all the writes at the end:
+
+        with MutationPool() as pool:
+            for entity in entities:
+                pool.put(entity)
+
+    Writes are only sent when the block finishes without an exception, but earlier batches will
+    already have been written, so whatever uses a pool should be safe to run again.
+    """
+
+    def __init__(self, maxcount=100, maxbytes=512 * 1024):
+        self.maxcount = maxcount
+        self.maxbytes = maxbytes
+        self._puts = []
+        self._putbytes = 0
+        self._deletes = []
+        self._deletebytes = 0
+        self._rpcs = []
+        self._putids = set()
+
+    def put(self, entity, size=None):
+        """Buffers a put. Pass size if the entity's encoded size is already known."""
+        self._puts.append(entity)
+        self._putids.add(id(entity))
+        self._putbytes += size if size is not None else len(entity._to_pb().Encode())
+        if len(self._puts) >= self.maxcount or self._putbytes >= self.maxbytes:
+            self._flush_puts()
+
+    def has_put(self, entity):
+        """Returns True if this entity has been put through the pool."""
+        return id(entity) in self._putids
+
+    def delete(self, key):
+        self._deletes.append(key)
+        self._deletebytes += len(key.serialized())
+        if len(self._deletes) >= self.maxcount or self._deletebytes >= self.maxbytes:
+            self._flush_deletes()
+
+    def _flush_puts(self):
+        if self._puts:
+            logdebug("MutationPool: putting %s entities (%s bytes)", len(self._puts), self._putbytes)
+            self._rpcs.extend(ndb.put_multi_async(self._puts))
+            self._puts = []
+            self._putbytes = 0
+
+    def _flush_deletes(self):
+        if self._deletes:
+            logdebug("MutationPool: deleting %s keys", len(self._deletes))
+            self._rpcs.extend(ndb.delete_multi_async(self._deletes))
+            self._deletes = []
+            self._deletebytes = 0
+
+    def flush(self):
+        """Sends everything that's waiting, and waits for all the writes sent so far."""
+        self._flush_puts()
+        self._flush_deletes()
+        rpcs = self._rpcs
+        self._rpcs = []
+        ndb.Future.wait_all(rpcs)
+        for rpc in rpcs:
+            rpc.check_success()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            # don't leave writes in flight, but don't hide the original exception either
+            ndb.Future.wait_all(self._rpcs)
+            self._rpcs = []
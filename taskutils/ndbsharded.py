@@ -1,16 +1,26 @@
+import hashlib
+import pickle
+import time
+import uuid
+
+import cloudpickle
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from google.appengine.ext.key_range import KeyRange
 
-from task import task, RetryTaskException
+from task import task, RetryTaskException, TaskBatch, PermanentTaskFailure
 from taskutils.future import GenerateOnAllChildSuccess, generatefuturepagemapf, \
-    setlocalprogress, GetFutureAndCheckReady
-from taskutils.future import future, FutureReadyForResult, FutureNotReadyForResult
-from taskutils.util import logdebug
+    setlocalprogress, GetFutureAndCheckReady, get_taskonlykwargs
+from taskutils.future import future, future_many, FutureReadyForResult, FutureNotReadyForResult
+from taskutils import metrics
+from taskutils.mutationpool import MutationPool
+from taskutils.util import logdebug, logdebugsampled
 
 
-def ndbshardedpagemap(pagemapf=None, ndbquery=None, initialshards=10, pagesize=100, **taskkwargs):
+def ndbshardedpagemap(pagemapf=None, ndbquery=None, initialshards=10, pagesize=100, splitpolicy=None, **taskkwargs):
     @task(**taskkwargs)
     def MapOverRange(keyrange, **kwargs):
-        logdebug("Enter MapOverRange: %s" % keyrange)
+        logdebug("Enter MapOverRange: %s", keyrange)
 
         _fixkeyend(keyrange, kind)
 
@@ -18,103 +28,243 @@ def ndbshardedpagemap(pagemapf=None, ndbquery=None, initialshards=10, pagesize=1
 
         logdebug(filteredquery)
 
+        starttime = time.time()
         keys, _, more = filteredquery.fetch_page(pagesize, keys_only=True)
+        fetchsec = time.time() - starttime
 
         if pagemapf:
             pagemapf(keys)
 
         if more and keys:
             newkeyrange = KeyRange(keys[-1], keyrange.key_end, keyrange.direction, False, keyrange.include_end)
-            krlist = newkeyrange.split_range()
-            logdebug("krlist: %s" % krlist)
-            for kr in krlist:
-                MapOverRange(kr)
-        logdebug("Leave MapOverRange: %s" % keyrange)
+            krlist = _split_remaining(splitpolicy, newkeyrange, keys, pagesize, fetchsec)
+            logdebug("krlist: %s", krlist)
+            with TaskBatch():
+                for kr in krlist:
+                    MapOverRange(kr)
+        elif splitpolicy:
+            splitpolicy.finished()
+        logdebug("Leave MapOverRange: %s", keyrange)
 
     kind = ndbquery.kind
 
-    krlist = KeyRange.compute_split_points(kind, initialshards)
-    logdebug("first krlist: %s" % krlist)
-
-    for kr in krlist:
-        MapOverRange(kr)
+    krlist = compute_query_split_points(ndbquery, initialshards)
+    logdebug("first krlist: %s", krlist)
+    if splitpolicy:
+        splitpolicy.started(len(krlist))
 
+    with TaskBatch():
+        for kr in krlist:
+            MapOverRange(kr)
+
+
+def ndbshardedmap(mapf=None, ndbquery=None, initialshards=10, pagesize=100, skipmissing=False, pagemode=False,
+                  usepool=False, poolargs=None, splitpolicy=None, **taskkwargs):
+    """Calls mapf(entity) for every entity the query finds, in tasks.
+
+    By default every entity gets a task of its own. With pagemode=True each page of keys is handled
+    by one task, which gets the entities with one get_multi and writes the ones mapf changed in
+    batches, so mapf should just modify the entity rather than put() it.
+
+    Args:
+      usepool: If True, mapf is called as mapf(entity, pool=pool), with a MutationPool to put and
+        delete through. The pool is flushed at the end of each task.
+      poolargs: Keyword arguments for the MutationPool, eg: maxcount and maxbytes.
+      splitpolicy: How to split what's left of a range after each page, eg: AdaptiveSplitPolicy.
+        By default it's split in two.
+    """
+    invokemaptaskkwargs = dict(taskkwargs)
+    invokemaptaskkwargs.setdefault("cachefunction", True)
+
+    @task(**invokemaptaskkwargs)
+    def InvokeMapPage(keys, **kwargs):
+        logdebug("Enter InvokeMapPage: %s keys", len(keys))
+        try:
+            objs = [objfuture.get_result() for objfuture in ndb.get_multi_async(keys)]
+            if not skipmissing and not all(objs):
+                # before mapping anything, so a retry doesn't map anything twice
+                raise RetryTaskException("couldn't get objects for keys %s" % [
+                    key for key, obj in zip(keys, objs) if not obj])
+
+            with MutationPool(**(poolargs or {})) as pool:
+                mapkwargs = dict(kwargs, pool=pool) if usepool else kwargs
+                for obj in objs:
+                    if obj:
+                        before = obj._to_pb().Encode()
+                        mapf(obj, **mapkwargs)
+                        if not pool.has_put(obj):
+                            after = obj._to_pb().Encode()
+                            if after != before:
+                                pool.put(obj, size=len(after))
+        finally:
+            logdebug("Leave InvokeMapPage: %s keys", len(keys))
 
-def ndbshardedmap(mapf=None, ndbquery=None, initialshards=10, pagesize=100, skipmissing=False, **taskkwargs):
-    @task(**taskkwargs)
+    @task(**invokemaptaskkwargs)
     def InvokeMap(key, **kwargs):
-        logdebug("Enter InvokeMap: %s" % key)
+        logdebug("Enter InvokeMap: %s", key)
         try:
             obj = key.get()
             if not obj:
                 if not skipmissing:
                     raise RetryTaskException("couldn't get object for key %s" % key)
                 # else just skip
+            elif usepool:
+                with MutationPool(**(poolargs or {})) as pool:
+                    mapf(obj, pool=pool, **kwargs)
             else:
                 mapf(obj, **kwargs)
         finally:
-            logdebug("Leave InvokeMap: %s" % key)
+            logdebug("Leave InvokeMap: %s", key)
 
     def ProcessPage(keys):
-        for index, key in enumerate(keys):
-            logdebug("Key #%s: %s" % (index, key))
-            InvokeMap(key)
+        if pagemode:
+            if keys:
+                InvokeMapPage(keys)
+            return
+        with TaskBatch():
+            for index, key in enumerate(keys):
+                logdebugsampled(0.01, "Key #%s: %s", index, key)
+                InvokeMap(key)
+
+    ndbshardedpagemap(ProcessPage, ndbquery, initialshards, pagesize, splitpolicy=splitpolicy, **taskkwargs)
+
+
+class _NdbMapJob(ndb.Model):
+    """A checkpointed futurendbshardedmap, see resume."""
+    stored = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    configser = ndb.BlobProperty()  # the futurendbshardedpagemap arguments
+    futurekey = ndb.KeyProperty()  # the top future of the latest run, None while a resume is starting one
+    runs = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class _NdbMapRange(ndb.Model):
+    """A key range of a checkpointed map whose page future succeeded.
+
+    These are root entities, found by jobkey, so a job's pages can be recorded in parallel.
+    """
+    jobkey = ndb.KeyProperty()
+    key_start = ndb.KeyProperty()
+    include_start = ndb.BooleanProperty(indexed=False)
+    key_end = ndb.KeyProperty(indexed=False)
+    include_end = ndb.BooleanProperty(indexed=False)
+    pagefuturekey = ndb.KeyProperty(indexed=False)
+
+
+def _tondbkey(key):
+    return ndb.Key.from_old_key(key) if key and not isinstance(key, ndb.Key) else key
+
+
+def _generatecheckpointf(jobkey, key_start, include_start, key_end, include_end):
+    # keyed by where the range starts, so a page that's mapped again (eg: its MapOverRange was
+    # retried) replaces its earlier record rather than adding another
+    rangeid = "%s-%s" % (jobkey.id(), _tondbkey(key_start).urlsafe() if key_start else "")
+
+    def checkpoint(pagefuturekey):
+        _NdbMapRange(id=rangeid, jobkey=jobkey, key_start=_tondbkey(key_start), include_start=include_start,
+                     key_end=_tondbkey(key_end), include_end=include_end, pagefuturekey=pagefuturekey).put()
+
+    return checkpoint
 
-    ndbshardedpagemap(ProcessPage, ndbquery, initialshards, pagesize, **taskkwargs)
+
+def _is_current_run(jobkey, topfuturekey):
+    # resume clears the job's futurekey before it starts the next run, which then sets it
+    job = jobkey.get()
+    return job is not None and job.futurekey in (None, topfuturekey)
 
 
 def futurendbshardedpagemap(pagemapf=None, ndbquery=None, pagesize=100, onsuccessf=None, onfailuref=None,
                             onprogressf=None, onallchildsuccessf=None, initialresult=None, oncombineresultsf=None,
-                            weight=None, parentkey=None, **taskkwargs):
+                            weight=None, parentkey=None, incremental=False, splitpolicy=None, jobid=None,
+                            resumestate=None, **taskkwargs):
+    """Calls pagemapf(futurekey, keys) for each page of keys the query finds, in a tree of futures.
+
+    Args:
+      jobid: If given, the ranges whose pages are done are recorded under this id, so the map can
+        be carried on with resume(jobid) if it dies part way through.
+      resumestate: Used by resume, (ranges still to do, combined result of the ranges done).
+    """
     kind = ndbquery.kind
 
-    krlist = KeyRange.compute_split_points(kind, 5)
-    logdebug("first krlist: %s" % krlist)
+    if resumestate:
+        krlist, priorresult = resumestate
+    else:
+        krlist = compute_query_split_points(ndbquery, 5)
+        priorresult = initialresult
+    logdebug("first krlist: %s", krlist)
+    if splitpolicy:
+        splitpolicy.started(len(krlist))
     logdebug(taskkwargs)
 
+    jobkey = None
+    if jobid:
+        jobkey = ndb.Key(_NdbMapJob, jobid)
+        if not resumestate:
+            config = dict(pagemapf=pagemapf, ndbquery=ndbquery, pagesize=pagesize, onsuccessf=onsuccessf,
+                          onfailuref=onfailuref, onprogressf=onprogressf, onallchildsuccessf=onallchildsuccessf,
+                          initialresult=initialresult, oncombineresultsf=oncombineresultsf, weight=weight,
+                          parentkey=parentkey, incremental=incremental, splitpolicy=splitpolicy,
+                          taskkwargs=taskkwargs)
+            _NdbMapJob(key=jobkey, configser=cloudpickle.dumps(config)).put()
+
     @future(onsuccessf=onsuccessf, onfailuref=onfailuref, onprogressf=onprogressf,
             onallchildsuccessf=onallchildsuccessf, parentkey=parentkey, weight=weight, **taskkwargs)
     def dofuturendbshardedmap(futurekey):
         logdebug(taskkwargs)
+        topfuturekey = futurekey
 
         linitialresult = 0 if initialresult is None else initialresult
         loncombineresultsf = oncombineresultsf if oncombineresultsf else lambda a, b: a + b
 
         def MapOverRange(futurekey, keyrange, weight, **kwargs):
-            logdebug("Enter MapOverRange: %s" % keyrange)
+            logdebug("Enter MapOverRange: %s", keyrange)
             try:
+                if jobkey and not _is_current_run(jobkey, topfuturekey):
+                    # a cancelled run's tasks can still be queued, they mustn't map ranges the new run will
+                    raise PermanentTaskFailure("sharded map job %s has been resumed, stopping this run" % jobkey.id())
+
+                rangeend = keyrange.key_end
                 _fixkeyend(keyrange, kind)
 
                 filteredquery = keyrange.filter_ndb_query(ndbquery)
 
                 logdebug(filteredquery)
 
+                starttime = time.time()
                 keys, _, more = filteredquery.fetch_page(pagesize, keys_only=True)
+                fetchsec = time.time() - starttime
 
                 lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, 0 if pagemapf else len(keys),
                                                                 lambda a, b: a + b)
 
                 if pagemapf:
                     futurename = "pagemap %s of %s" % (len(keys), keyrange)
-                    lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf)
+                    lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf,
+                                                                    incremental=incremental)
+                    lonsuccessf = None
+                    if jobkey:
+                        # the page covers the rest of the range if there's no more
+                        lonsuccessf = _generatecheckpointf(
+                            jobkey, keyrange.key_start, keyrange.include_start,
+                            keys[-1] if more and keys else rangeend, True if more and keys else keyrange.include_end)
                     future(pagemapf, parentkey=futurekey, futurename=futurename, onallchildsuccessf=lonallchildsuccessf,
-                           weight=len(keys), **taskkwargs)(keys)
+                           onsuccessf=lonsuccessf, weight=len(keys), **taskkwargs)(keys)
                 else:
-                    setlocalprogress(futurekey, len(keys))
+                    setlocalprogress(futurekey, len(keys), taskkwargs=taskkwargs)
 
                 if more and keys:
                     lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey,
                                                                     linitialresult if pagemapf else len(keys),
-                                                                    loncombineresultsf)
+                                                                    loncombineresultsf, incremental=incremental)
                     newkeyrange = KeyRange(keys[-1], keyrange.key_end, keyrange.direction, False, keyrange.include_end)
-                    krlist = newkeyrange.split_range()
-                    logdebug("krlist: %s" % krlist)
+                    krlist = _split_remaining(splitpolicy, newkeyrange, keys, pagesize, fetchsec)
+                    logdebug("krlist: %s", krlist)
                     newweight = (weight / len(krlist)) - len(keys) if weight else None
-                    for kr in krlist:
-                        futurename = "shard %s" % kr
-                        future(MapOverRange, parentkey=futurekey, futurename=futurename,
-                               onallchildsuccessf=lonallchildsuccessf, weight=newweight, **taskkwargs)(kr,
-                                                                                                       weight=newweight)
+                    future_many(MapOverRange, [(kr, newweight) for kr in krlist], parentkey=futurekey,
+                                futurenameprefix="shard", onallchildsuccessf=lonallchildsuccessf, weight=newweight,
+                                **taskkwargs)
+                elif splitpolicy:
+                    splitpolicy.finished()
                 #
                 if pagemapf or (more and keys):
                     #                 if (more and keys):
@@ -123,25 +273,118 @@ def futurendbshardedpagemap(pagemapf=None, ndbquery=None, pagesize=100, onsucces
                     return len(keys)  # (len(keys), 0, keyrange)
             #                 return len(keys)
             finally:
-                logdebug("Leave MapOverRange: %s" % keyrange)
+                logdebug("Leave MapOverRange: %s", keyrange)
 
-        for kr in krlist:
-            lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult, loncombineresultsf)
+        if not krlist:
+            return linitialresult if priorresult is None else priorresult
 
-            futurename = "shard %s" % kr
+        # when resuming, the top level starts from what was done before
+        lonallchildsuccessf = GenerateOnAllChildSuccess(futurekey, linitialresult if priorresult is None else priorresult,
+                                                        loncombineresultsf, incremental=incremental)
 
-            newweight = weight / len(krlist) if weight else None
-            future(MapOverRange, parentkey=futurekey, futurename=futurename, onallchildsuccessf=lonallchildsuccessf,
-                   weight=newweight, **taskkwargs)(kr, weight=newweight)
+        newweight = weight / len(krlist) if weight else None
+        future_many(MapOverRange, [(kr, newweight) for kr in krlist], parentkey=futurekey, futurenameprefix="shard",
+                    onallchildsuccessf=lonallchildsuccessf, weight=newweight, **taskkwargs)
 
         raise FutureReadyForResult("still going")
 
-    return dofuturendbshardedmap()
+    futureobj = dofuturendbshardedmap()
+    if jobkey:
+        @ndb.transactional()
+        def setfuturekey():
+            job = jobkey.get()
+            job.futurekey = futureobj.key
+            job.runs += 1
+            job.put()
+
+        setfuturekey()
+    return futureobj
+
+
+# how many finished ranges each resume task reads
+_RESUME_BATCH = 500
+
+
+def resume(jobid, shards=5):
+    """Carries on a futurendbshardedmap (or futurendbshardedpagemap) that was started with this jobid.
+
+    The last run's top future is cancelled, and the job is marked so any of its MapOverRange
+    tasks still queued stop without mapping anything. Then a chain of tasks reads the finished
+    ranges in order, _RESUME_BATCH at a time, combining the results of their pages and noting the
+    gaps between them. The gaps are split with split_key_ranges and
+    mapped under a new top future, whose result includes the results of the finished pages.
+
+    Returns the job's key. Its futurekey is set to the new top future once that's started. If the
+    last run already succeeded, nothing is done.
+    """
+    jobkey = ndb.Key(_NdbMapJob, jobid)
+    job = jobkey.get()
+    if not job:
+        raise Exception("no sharded map job %s" % jobid)
+
+    lastfuture = job.futurekey.get() if job.futurekey else None
+    if lastfuture and lastfuture.status == "success":
+        return jobkey
+
+    @ndb.transactional()
+    def endlastrun():
+        lastjob = jobkey.get()
+        lastjob.futurekey = None
+        lastjob.put()
+
+    endlastrun()
+    if lastfuture and not lastfuture.has_result():
+        lastfuture.cancel()
+
+    config = pickle.loads(job.configser)
+    taskkwargs = config.pop("taskkwargs")
+    # taskkwargs are the job's future() kwargs, which can include future() arguments
+    resumetaskkwargs = get_taskonlykwargs(taskkwargs)
+    resumetaskkwargs.pop("name", None)
+    combineresultsf = config["oncombineresultsf"] or (lambda a, b: a + b)
+    initialresult = 0 if config["initialresult"] is None else config["initialresult"]
+
+    @task(**resumetaskkwargs)
+    def ResumeJob(cursor, position, includeposition, atend, gaps, priorresult):
+        # position is where the finished ranges read so far stop covering the kind (None for its start)
+        query = _NdbMapRange.query(_NdbMapRange.jobkey == jobkey).order(_NdbMapRange.key_start)
+        doneranges, nextcursor, more = query.fetch_page(
+            _RESUME_BATCH, start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+        pagefutures = ndb.get_multi([donerange.pagefuturekey for donerange in doneranges])
+
+        for donerange, pagefuture in zip(doneranges, pagefutures):
+            if atend:
+                break
+            if position is not None and (donerange.key_start is None or
+                                         _keyorder(donerange.key_start) < _keyorder(position)):
+                # overlaps what's already covered; anything past that is left for a gap
+                continue
+            if not pagefuture or pagefuture.status != "success":
+                # treat it as not done, it'll be part of a gap
+                continue
+            if donerange.key_start != position:
+                gaps.append(KeyRange(position, donerange.key_start, KeyRange.ASC, includeposition,
+                                     not donerange.include_start))
+            priorresult = combineresultsf(priorresult, pagefuture.get_result())
+            position, includeposition = donerange.key_end, not donerange.include_end
+            atend = position is None
+
+        if more and nextcursor and not atend:
+            ResumeJob(nextcursor.urlsafe(), position, includeposition, atend, gaps, priorresult)
+        else:
+            if not atend:
+                gaps.append(KeyRange(position, None, KeyRange.ASC, includeposition, False))
+            krlist = split_key_ranges(config["ndbquery"], gaps, shards) if gaps else []
+            logdebug("resuming %s: %s gaps, %s ranges to do", jobid, len(gaps), len(krlist))
+            futurendbshardedpagemap(jobid=jobid, resumestate=(krlist, priorresult), **dict(config, **taskkwargs))
+
+    ResumeJob(None, None, True, False, [], initialresult)
+    return jobkey
 
 
 def generateinvokemapf(mapf):
     def InvokeMap(futurekey, key, **kwargs):
-        logdebug("Enter InvokeMap: %s" % key)
+        logdebug("Enter InvokeMap: %s", key)
         try:
             obj = key.get()
             if not obj:
@@ -149,20 +392,24 @@ def generateinvokemapf(mapf):
 
             return mapf(futurekey, obj, **kwargs)
         finally:
-            logdebug("Leave InvokeMap: %s" % key)
+            logdebug("Leave InvokeMap: %s", key)
 
     return InvokeMap
 
 
 def futurendbshardedmap(mapf=None, ndbquery=None, pagesize=100, onsuccessf=None, onfailuref=None, onprogressf=None,
                         onallchildsuccessf=None, initialresult=None, oncombineresultsf=None, weight=None,
-                        parentkey=None, **taskkwargs):
+                        parentkey=None, incremental=False, leafsize=None, peritemfutures=False, usepool=False,
+                        poolargs=None, splitpolicy=None, jobid=None, **taskkwargs):
     invokeMapF = generateinvokemapf(mapf)
-    pageMapF = generatefuturepagemapf(invokeMapF, initialresult, oncombineresultsf, **taskkwargs)
+    pageMapF = generatefuturepagemapf(invokeMapF, initialresult, oncombineresultsf, incremental=incremental,
+                                      leafsize=leafsize, peritemfutures=peritemfutures, usepool=usepool,
+                                      poolargs=poolargs, **taskkwargs)
     return futurendbshardedpagemap(pageMapF, ndbquery, pagesize, onsuccessf=onsuccessf, onfailuref=onfailuref,
                                    onprogressf=onprogressf, onallchildsuccessf=onallchildsuccessf,
                                    initialresult=initialresult, oncombineresultsf=oncombineresultsf,
-                                   parentkey=parentkey, weight=weight, **taskkwargs)
+                                   parentkey=parentkey, weight=weight, incremental=incremental,
+                                   splitpolicy=splitpolicy, jobid=jobid, **taskkwargs)
 
 
 def futurendbshardedpagemapwithcount(pagemapf=None, ndbquery=None, pagesize=100, onsuccessf=None, onfailuref=None,
@@ -211,18 +458,206 @@ def futurendbshardedpagemapwithcount(pagemapf=None, ndbquery=None, pagesize=100,
 
 def futurendbshardedmapwithcount(mapf=None, ndbquery=None, pagesize=100, onsuccessf=None, onfailuref=None,
                                  onprogressf=None, onallchildsuccessf=None, initialresult=None, oncombineresultsf=None,
-                                 weight=None, parentkey=None, **taskkwargs):
+                                 weight=None, parentkey=None, leafsize=None, peritemfutures=False, usepool=False,
+                                 poolargs=None, **taskkwargs):
     invokeMapF = generateinvokemapf(mapf)
-    pageMapF = generatefuturepagemapf(invokeMapF, initialresult, oncombineresultsf, **taskkwargs)
+    pageMapF = generatefuturepagemapf(invokeMapF, initialresult, oncombineresultsf, leafsize=leafsize,
+                                      peritemfutures=peritemfutures, usepool=usepool, poolargs=poolargs,
+                                      **taskkwargs)
     return futurendbshardedpagemapwithcount(pageMapF, ndbquery, pagesize, onsuccessf=onsuccessf, onfailuref=onfailuref,
                                             onprogressf=onprogressf, onallchildsuccessf=onallchildsuccessf,
                                             initialresult=initialresult, oncombineresultsf=oncombineresultsf,
                                             parentkey=parentkey, **taskkwargs)
 
 
+_SPLIT_CACHE_PREFIX = "ndbsplit-"
+_INFLIGHT_CACHE_PREFIX = "ndbshards-"
+
+
+def _split_remaining(splitpolicy, keyrange, keys, pagesize, fetchsec):
+    if splitpolicy:
+        return splitpolicy.split(keyrange, keys, pagesize, fetchsec)
+    return keyrange.split_range()
+
+
+def _split_into(keyrange, pieces):
+    """Splits a KeyRange in halves, and those in halves, etc, into at most pieces ranges."""
+    krlist = [keyrange]
+    while len(krlist) * 2 <= pieces:
+        newkrlist = [half for kr in krlist for half in kr.split_range()]
+        if len(newkrlist) == len(krlist):
+            break
+        krlist = newkrlist
+    return krlist
+
+
+def _keyid(key):
+    return key.id_or_name() if hasattr(key, "id_or_name") else key.id()
+
+
+class AdaptiveSplitPolicy(object):
+    """Decides how to split what's left of a range after a page, from how the page went.
+
+    The number of remaining pages is estimated from the spread of the page's ids (for integer
+    ids, like auto allocated ones), and the range is split into about one piece per pagespershard
+    of them, so long ranges are split more and ranges with only a few pages left aren't split at
+    all. Ranges whose page took longer than hotsec to fetch are split twice as much. Ranges are
+    only split in two when there's no estimate.
+
+    The number of ranges in flight is kept in a memcache counter, and no range is split while
+    there are maxinflight of them. Retried tasks and evictions make it approximate.
+
+    Page fetch times and estimates are recorded as metrics under "ndbshardedmap".
+    """
+
+    def __init__(self, maxinflight=200, maxsplit=8, pagespershard=10, hotsec=1.0):
+        self.maxinflight = maxinflight
+        self.maxsplit = maxsplit
+        self.pagespershard = pagespershard
+        self.hotsec = hotsec
+        self.jobid = uuid.uuid4().hex
+
+    def _inflightkey(self):
+        return "%s%s" % (_INFLIGHT_CACHE_PREFIX, self.jobid)
+
+    def started(self, count):
+        memcache.set(self._inflightkey(), count, time=24 * 60 * 60)
+
+    def finished(self):
+        memcache.decr(self._inflightkey())
+
+    def estimate_remaining_pages(self, keyrange, keys, pagesize):
+        """Returns about how many pages are left in keyrange, or None if it can't tell."""
+        if not keyrange.key_end:
+            return None
+        firstid, lastid, endid = _keyid(keys[0]), _keyid(keys[-1]), _keyid(keyrange.key_end)
+        if not all(isinstance(keyid, (int, long)) for keyid in (firstid, lastid, endid)) or endid <= lastid:
+            return None
+        idsperpage = max(lastid - firstid, 1) * float(pagesize) / len(keys)
+        return (endid - lastid) / idsperpage
+
+    def split(self, keyrange, keys, pagesize, fetchsec):
+        remainingpages = self.estimate_remaining_pages(keyrange, keys, pagesize)
+        metrics.record("ndbshardedmap", "pagefetchsec", fetchsec)
+        if remainingpages is not None:
+            metrics.record("ndbshardedmap", "remainingpages", remainingpages)
+
+        if remainingpages is None:
+            pieces = 2
+        else:
+            pieces = int(remainingpages / self.pagespershard)
+        if fetchsec > self.hotsec:
+            pieces *= 2
+        pieces = max(1, min(pieces, self.maxsplit))
+
+        if pieces > 1:
+            inflight = memcache.get(self._inflightkey()) or 0
+            pieces = max(1, min(pieces, self.maxinflight - inflight + 1))
+
+        krlist = _split_into(keyrange, pieces)
+        if len(krlist) > 1:
+            memcache.incr(self._inflightkey(), len(krlist) - 1, initial_value=0)
+        logdebug("split with %s pages left (%.2fs page) into %s", remainingpages, fetchsec, len(krlist))
+        return krlist
+
+
+def compute_query_split_points(ndbquery, shards, oversample=4, countlimit=1000, cachesec=60 * 60):
+    """Splits a query's kind into about shards KeyRanges holding similar numbers of the query's results.
+
+    Unfiltered queries are split with KeyRange.compute_split_points, from the kind's __scatter__
+    sample. Scatter queries can't take the query's filters, so for filtered queries the kind is
+    split oversample times finer, the query's results in each piece are counted (up to countlimit,
+    in parallel), and neighbouring pieces are joined into shards of about equal count. Pieces with
+    no results are joined onto a neighbour, so the ranges still cover the whole kind.
+
+    The split is cached in memcache for cachesec seconds, by the query and number of shards, so
+    repeat runs don't count again.
+    """
+    if not ndbquery.filters and not ndbquery.ancestor:
+        return KeyRange.compute_split_points(ndbquery.kind, shards)
+
+    cachekey = "%s%s" % (_SPLIT_CACHE_PREFIX, hashlib.md5("%r-%s" % (ndbquery, shards)).hexdigest())
+    krlist = memcache.get(cachekey)
+    if krlist:
+        logdebug("cached split points for %s", ndbquery)
+        return krlist
+
+    pieces = KeyRange.compute_split_points(ndbquery.kind, shards * oversample)
+    krlist = _join_counted(pieces, _count_pieces(ndbquery, [pieces], countlimit)[0], shards)
+
+    memcache.set(cachekey, krlist, time=cachesec)
+    return krlist
+
+
+def split_key_ranges(ndbquery, krlist, shards, oversample=4, countlimit=1000):
+    """Splits each of some KeyRanges into up to shards ranges, like compute_query_split_points does the kind.
+
+    One __scatter__ sample of the kind is taken for all the ranges, so a range gets pieces in
+    proportion to how much of the kind it holds, and small ranges may not be split at all. For
+    filtered queries the results in all the pieces are counted in one go.
+    """
+    samplesize = min(shards * oversample * len(krlist), 1000)
+    scatterkeys = sorted([_tondbkey(kr.key_start) for kr in KeyRange.compute_split_points(ndbquery.kind, samplesize)
+                          if kr.key_start], key=_keyorder)
+    pieceslists = [_pieces_within(kr, scatterkeys) for kr in krlist]
+    if ndbquery.filters or ndbquery.ancestor:
+        countslists = _count_pieces(ndbquery, pieceslists, countlimit)
+    else:
+        countslists = [[1] * len(pieces) for pieces in pieceslists]
+    return [shard for pieces, counts in zip(pieceslists, countslists) for shard in _join_counted(pieces, counts, shards)]
+
+
+def _keyorder(key):
+    return _tondbkey(key).flat()
+
+
+def _pieces_within(keyrange, scatterkeys):
+    """Splits keyrange at the scatter keys inside it."""
+    inside = [key for key in scatterkeys
+              if (not keyrange.key_start or _keyorder(key) > _keyorder(keyrange.key_start)) and
+              (not keyrange.key_end or _keyorder(key) < _keyorder(keyrange.key_end))]
+    bounds = [keyrange.key_start] + inside + [keyrange.key_end]
+    return [
+        KeyRange(bounds[index], bounds[index + 1], keyrange.direction,
+                 keyrange.include_start if index == 0 else True,
+                 keyrange.include_end if index == len(inside) else False)
+        for index in range(len(inside) + 1)
+    ]
+
+
+def _count_pieces(ndbquery, pieceslists, countlimit):
+    """Counts the query's results (up to countlimit) in every piece, in parallel."""
+    countfutures = [[piece.filter_ndb_query(ndbquery).count_async(countlimit) for piece in pieces]
+                    for pieces in pieceslists]
+    countslists = [[countfuture.get_result() for countfuture in futures] for futures in countfutures]
+    logdebug("counts for split pieces: %s", countslists)
+    return countslists
+
+
+def _join_counted(pieces, counts, shards):
+    """Joins neighbouring pieces into up to shards ranges of about equal count."""
+    target = max(sum(counts) / float(shards), 1)
+    krlist = []
+    first = 0
+    total = 0
+    for index, count in enumerate(counts):
+        total += count
+        # cut once this shard has its share, unless only empty pieces are left
+        if total >= target * (len(krlist) + 1) and any(counts[index + 1:]):
+            krlist.append(_join_ranges(pieces[first:index + 1]))
+            first = index + 1
+    krlist.append(_join_ranges(pieces[first:]))
+    return krlist
+
+
+def _join_ranges(pieces):
+    return KeyRange(pieces[0].key_start, pieces[-1].key_end, pieces[0].direction, pieces[0].include_start,
+                    pieces[-1].include_end)
+
+
 def _fixkeyend(keyrange, kind):
     if keyrange.key_start and not keyrange.key_end:
         endkey = KeyRange.guess_end_key(kind, keyrange.key_start)
         if endkey and endkey > keyrange.key_start:
-            logdebug("Fixing end: %s" % endkey)
+            logdebug("Fixing end: %s", endkey)
             keyrange.key_end = endkey
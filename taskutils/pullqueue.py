@@ -0,0 +1,92 @@
+import threading
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from taskutils.backend import TaskHeaders
+from taskutils.metrics import get_metricssink
+from taskutils.task import task, _run, PermanentTaskFailure
+from taskutils.util import logdebug, logexception
+
+
+def _run_leased(leased, queue, numthreads):
+    """Runs leased tasks on up to numthreads threads.
+
+    Returns:
+      The tasks that are finished with, ie: that succeeded or failed permanently.
+    """
+    pending = list(reversed(leased))
+    finished = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                t = pending.pop()
+            headers = TaskHeaders({
+                "X-AppEngine-TaskName": t.name,
+                "X-AppEngine-QueueName": queue,
+                "X-AppEngine-TaskRetryCount": str(t.retry_count),
+            })
+            try:
+                logdebug('before run "%s"', t.tag)
+                # a fresh context per task, like a separate request
+                ndb.toplevel(_run)(t.payload, headers, (t.tag or "").lower() if get_metricssink() else None)
+                logdebug('after run "%s"', t.tag)
+            except PermanentTaskFailure:
+                logexception("Aborting task")
+            except Exception:
+                # leave it leased, it'll be retried when the lease runs out
+                logexception("failure")
+                continue
+            with lock:
+                finished.append(t)
+
+    threads = [threading.Thread(target=work) for _ in range(min(numthreads, len(leased)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return finished
+
+
+def pullworker(queue="pull", leasesec=60, batchsize=100, numthreads=10, maxsec=540):
+    """Leases tasks from a pull queue in batches, runs them, and deletes the finished ones in bulk.
+
+    Use task(..., pull=True, queue=<pull queue>) to enqueue tasks for it. Tasks that fail are
+    left to be leased again when their lease expires.
+
+    Args:
+      queue: Name of the pull queue.
+      leasesec: Lease time for each batch. Must be longer than a batch takes to run.
+      batchsize: Tasks to lease at a time (at most 1000).
+      numthreads: Tasks to run at once.
+      maxsec: Stop leasing new batches after this long.
+    Returns:
+      True if the worker stopped because it ran out of time, False if the queue was empty.
+    """
+    q = taskqueue.Queue(queue)
+    started = time.time()
+    while time.time() - started < maxsec:
+        leased = q.lease_tasks(leasesec, batchsize)
+        logdebug("leased %s tasks from %s", len(leased), queue)
+        if not leased:
+            return False
+        finished = _run_leased(leased, queue, numthreads)
+        if finished:
+            q.delete_tasks(finished)
+    return True
+
+
+def startpullworker(pullqueue="pull", leasesec=60, batchsize=100, numthreads=10, maxsec=540, **taskkwargs):
+    """Runs pullworker in a push task, which re-enqueues itself until the pull queue is empty."""
+
+    @task(**taskkwargs)
+    def PullWorker():
+        if pullworker(pullqueue, leasesec, batchsize, numthreads, maxsec):
+            PullWorker()
+
+    PullWorker()
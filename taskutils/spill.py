@@ -0,0 +1,121 @@
+import os
+import uuid
+
+import cloudstorage as gcs
+from google.appengine.api import app_identity
+from google.appengine.ext import ndb
+
+from taskutils.util import logdebug
+
+# write in pieces, so the gcs client can stream rather than buffer one huge write
+_WRITE_CHUNK_BYTES = 256 * 1024
+
+# comfortably under the datastore's 1 MB entity limit
+_DATASTORE_CHUNK_BYTES = 900 * 1024
+
+
+class GCSSpillStore(object):
+    """Stores large payloads as objects in Google Cloud Storage.
+
+    Objects are deleted once they've been used. Anything left behind (eg: a payload written in a
+    transaction that rolled back) can be cleaned up with a lifecycle rule on the prefix.
+    """
+
+    def __init__(self, bucketname=None, prefix="taskspill"):
+        self.bucketname = bucketname
+        self.prefix = prefix
+
+    def write(self, data):
+        bucket = self.bucketname if self.bucketname else os.environ.get(
+            'BUCKET_NAME',
+            app_identity.get_default_gcs_bucket_name())
+
+        path = "/%s/%s/%s" % (bucket, self.prefix, uuid.uuid4())
+        logdebug("spilling %s bytes to %s", len(data), path)
+
+        with gcs.open(path, "w", content_type="application/octet-stream") as spillfile:
+            for index in range(0, len(data), _WRITE_CHUNK_BYTES):
+                spillfile.write(data[index:index + _WRITE_CHUNK_BYTES])
+        return path
+
+    def read(self, ref):
+        try:
+            with gcs.open(ref) as spillfile:
+                return spillfile.read()
+        except gcs.NotFoundError:
+            return None
+
+    def delete(self, ref):
+        try:
+            gcs.delete(ref)
+        except gcs.NotFoundError:
+            pass
+
+
+class LocalSpillStore(object):
+    """Stores large payloads as files in a local directory. A stand-in for GCSSpillStore in tests."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, str(uuid.uuid4()))
+        with open(path, "wb") as spillfile:
+            spillfile.write(data)
+        return path
+
+    def read(self, ref):
+        if not os.path.exists(ref):
+            return None
+        with open(ref, "rb") as spillfile:
+            return spillfile.read()
+
+    def delete(self, ref):
+        if os.path.exists(ref):
+            os.remove(ref)
+
+
+class _SpillChunk(ndb.Model):
+    """One piece of a payload stored by DatastoreChunkStore."""
+    _use_cache = False
+    _use_memcache = False
+
+    data = ndb.BlobProperty()
+
+
+class DatastoreChunkStore(object):
+    """Stores large payloads in the datastore, split over as many entities as they need.
+
+    Needs no other services, but every MB is another entity to write and read, so GCSSpillStore
+    is better for really big payloads.
+    """
+
+    def __init__(self, prefix="spill"):
+        self.prefix = prefix
+
+    @staticmethod
+    def _chunk_keys(ref):
+        refid, count = ref.rsplit(":", 1)
+        return [ndb.Key(_SpillChunk, "%s-%s" % (refid, index)) for index in range(int(count))]
+
+    @ndb.non_transactional()
+    def write(self, data):
+        refid = "%s-%s" % (self.prefix, uuid.uuid4())
+        chunks = [data[index:index + _DATASTORE_CHUNK_BYTES] for index in range(0, len(data), _DATASTORE_CHUNK_BYTES)]
+        ref = "%s:%s" % (refid, len(chunks))
+        logdebug("spilling %s bytes to %s", len(data), ref)
+        ndb.put_multi([_SpillChunk(key=key, data=chunk) for key, chunk in zip(self._chunk_keys(ref), chunks)])
+        return ref
+
+    @ndb.non_transactional()
+    def read(self, ref):
+        chunks = ndb.get_multi(self._chunk_keys(ref))
+        if not all(chunks):
+            return None
+        return "".join(chunk.data for chunk in chunks)
+
+    @ndb.non_transactional()
+    def delete(self, ref):
+        ndb.delete_multi(self._chunk_keys(ref))
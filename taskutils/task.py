@@ -1,16 +1,32 @@
 import functools
+import hashlib
+import importlib
 import pickle
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
 from copy import deepcopy
 
 import cloudpickle
 import webapp2
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.ext import webapp
 
+from taskutils.metrics import get_metricssink
 from taskutils.util import logdebug, logwarning, logexception, dumper, get_dump
 
 TASKUTILS_TASKROUTE = "/_ah/task"
+TASKUTILS_COMPRESSTHRESHOLD = None
+TASKUTILS_SPILLSTORE = None
+TASKUTILS_BACKEND = None
+
+# payloads bigger than this can't be stored in a _TaskToRun entity
+_MAX_DATASTORE_PAYLOAD_BYTES = 1000000
+TASKUTILS_SPILLTHRESHOLD = _MAX_DATASTORE_PAYLOAD_BYTES
 
 
 def set_taskroute(value):
@@ -23,6 +39,51 @@ def get_taskroute():
     return TASKUTILS_TASKROUTE
 
 
+def set_compressthreshold(value):
+    global TASKUTILS_COMPRESSTHRESHOLD
+    TASKUTILS_COMPRESSTHRESHOLD = value
+
+
+def get_compressthreshold():
+    global TASKUTILS_COMPRESSTHRESHOLD
+    return TASKUTILS_COMPRESSTHRESHOLD
+
+
+def set_backend(value):
+    """Sets what runs tasks; None (the default) for the App Engine task queue, or eg: backend.InlineBackend()."""
+    global TASKUTILS_BACKEND
+    TASKUTILS_BACKEND = value
+
+
+def get_backend():
+    global TASKUTILS_BACKEND
+    return TASKUTILS_BACKEND
+
+
+def set_spillstore(store, threshold=None):
+    """Sets where payloads too large for a task are stored.
+
+    Args:
+      store: A store with write(data) -> ref, read(ref) and delete(ref), eg: spill.GCSSpillStore, or
+        None to always use the datastore.
+      threshold: Payloads bigger than this many bytes go to the store, smaller ones still go to the
+        datastore. Defaults to the largest payload the datastore can hold.
+    """
+    global TASKUTILS_SPILLSTORE, TASKUTILS_SPILLTHRESHOLD
+    TASKUTILS_SPILLSTORE = store
+    TASKUTILS_SPILLTHRESHOLD = threshold if threshold is not None else _MAX_DATASTORE_PAYLOAD_BYTES
+
+
+def get_spillstore():
+    global TASKUTILS_SPILLSTORE
+    return TASKUTILS_SPILLSTORE
+
+
+def get_spillthreshold():
+    global TASKUTILS_SPILLTHRESHOLD
+    return TASKUTILS_SPILLTHRESHOLD
+
+
 def get_webapp_url():
     return "%s/(.*)" % get_taskroute()
 
@@ -36,6 +97,28 @@ def get_enqueue_url(suffix):
 
 _TASKQUEUE_HEADERS = {"Content-Type": "application/octet-stream"}
 
+_MAX_TASKS_PER_ADD = taskqueue.MAX_TASKS_PER_ADD
+
+# leaves room for the url and headers, which also count towards the task size
+_MAX_INLINE_PAYLOAD_BYTES = taskqueue.MAX_PUSH_TASK_SIZE_BYTES - 2048
+_MAX_INLINE_PULL_PAYLOAD_BYTES = taskqueue.MAX_PULL_TASK_SIZE_BYTES - 2048
+
+# pickles never start with a null byte, so this can't be confused with an uncompressed payload
+_ZLIB_MARKER = "\x00z"
+
+_local = threading.local()
+
+# functions bigger than this are left inline, they wouldn't fit in memcache
+_MAX_CACHED_FUNCTION_BYTES = 900000
+_MAX_LOADED_FUNCTIONS = 100
+_FUNCTION_CACHE_PREFIX = "taskfunction-"
+
+_registeredtasks = {}
+
+_storedfunctionhashes = set()
+_loadedfunctions = OrderedDict()
+_loadedfunctionslock = threading.Lock()
+
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -58,32 +141,347 @@ class _TaskToRun(ndb.Model):
     data = ndb.BlobProperty(required=True)  # up to 1 mb
 
 
-def _run(data, headers):
+class _TaskFunction(ndb.Model):
+    """Datastore copy of a pickled task function, keyed by the sha1 of the pickle.
+
+    Backs up the memcache entry used for task(cachefunction=True).
+    """
+    data = ndb.BlobProperty(required=True)
+
+
+class TaskBatch(object):
+    """Collects tasks enqueued by task() and adds them with bulk Queue.add() calls.
+
+    Use it as a context manager around a fan-out; every task() call made inside the block is
+    held back and added in groups of up to 100 tasks per RPC (grouped by queue). Full groups are
+    sent asynchronously as soon as they fill up, and the rest when the block exits, which then
+    waits for all of the RPCs. If the block raises, pending tasks are discarded.
+
+    Named and transactional tasks are added straight away, as if there were no batch, so that
+    duplicate name errors reach the caller and transactional tasks are added in their transaction.
+
+        with TaskBatch():
+            for key in keys:
+                InvokeMap(key)
+    """
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._rpcs = []
+        self._microbatches = OrderedDict()
+
+    def __enter__(self):
+        _get_batchstack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _get_batchstack().pop()
+        if exc_type:
+            self._pending.clear()
+            for token in self._microbatches:
+                _pop_microbatch(token)
+            self._microbatches.clear()
+            # groups already sent can't be taken back, but don't leave their RPCs outstanding
+            rpcs = self._rpcs
+            self._rpcs = []
+            for rpc in rpcs:
+                try:
+                    rpc.get_result()
+                except Exception:
+                    logexception("error adding tasks in aborted batch")
+        else:
+            self.flush()
+
+    def _attach(self, token, flushf):
+        """Arranges for a task(batch=N) function's buffered calls to be sent with this batch."""
+        self._microbatches[token] = flushf
+
+    def add(self, t, queue, transactional):
+        if t.name or transactional:
+            return _add_task(t, queue, transactional)
+        group = self._pending.setdefault(queue, [])
+        group.append(t)
+        if len(group) >= _MAX_TASKS_PER_ADD:
+            del self._pending[queue]
+            self._rpcs.append(_add_tasks_async(group, queue, False))
+        return t
+
+    def flush_async(self):
+        """Sends all pending tasks without waiting, and returns the outstanding RPCs."""
+        microbatches = self._microbatches
+        self._microbatches = OrderedDict()
+        for flushf in microbatches.values():
+            flushf(self)
+
+        pending = self._pending
+        self._pending = OrderedDict()
+        rpcs = self._rpcs
+        self._rpcs = []
+        for queue, tasks in pending.items():
+            for index in range(0, len(tasks), _MAX_TASKS_PER_ADD):
+                rpcs.append(_add_tasks_async(tasks[index:index + _MAX_TASKS_PER_ADD], queue, False))
+        return rpcs
+
+    def flush(self):
+        wait_all(self.flush_async())
+
+
+def _get_batchstack():
+    stack = getattr(_local, "batchstack", None)
+    if stack is None:
+        stack = _local.batchstack = []
+    return stack
+
+
+def _get_currentbatch():
+    stack = _get_batchstack()
+    return stack[-1] if stack else None
+
+
+def _get_microbatches():
+    microbatches = getattr(_local, "microbatches", None)
+    if microbatches is None:
+        microbatches = _local.microbatches = {}
+    return microbatches
+
+
+def _buffer_call(token, call):
+    """Buffers a call to a task(batch=N) function. Returns the buffered calls and when the first was made."""
+    microbatch = _get_microbatches().setdefault(token, ([], time.time()))
+    microbatch[0].append(call)
+    return microbatch
+
+
+def _pop_microbatch(token):
+    microbatch = _get_microbatches().pop(token, None)
+    return microbatch[0] if microbatch else None
+
+
+def _add_task(t, queue, transactional):
+    backend = get_backend()
+    if backend:
+        return backend.add(t, queue, transactional)
+    return t.add(queue, transactional=transactional)
+
+
+def _add_tasks_async(tasks, queue, transactional):
+    logdebug("adding %s tasks to %s", len(tasks) if isinstance(tasks, list) else 1, queue)
+    backend = get_backend()
+    if backend:
+        return backend.add_async(tasks, queue, transactional)
+    return taskqueue.Queue(queue).add_async(tasks, transactional=transactional)
+
+
+def wait_all(rpcs):
+    """Waits for a group of enqueue RPCs, as returned by add_async() or TaskBatch.flush_async().
+
+    All of the RPCs are allowed to finish before any error is raised.
+
+    Args:
+      rpcs: An iterable of RPCs.
+    Returns:
+      A list of the RPC results (the added task or tasks), in the same order.
+    """
+    rpcs = list(rpcs)
+    for rpc in rpcs:
+        rpc.wait()
+    return [rpc.get_result() for rpc in rpcs]
+
+
+def _compress_payload(pickled, threshold):
+    """Compresses a payload of at least threshold bytes, if that makes it smaller."""
+    if threshold is not None and len(pickled) >= threshold:
+        compressed = _ZLIB_MARKER + zlib.compress(pickled)
+        if len(compressed) < len(pickled):
+            logdebug("task payload compressed from %s to %s", len(pickled), len(compressed))
+            return compressed
+    return pickled
+
+
+def _decompress_payload(data):
+    if data.startswith(_ZLIB_MARKER):
+        return zlib.decompress(data[len(_ZLIB_MARKER):])
+    return data
+
+
+def register_task(f=None, version=None):
+    """Registers a module level function so that tasks send it by reference instead of pickling it.
+
+    The task payload carries the function's dotted path and version, and the function is
+    imported when the task runs. Use it under @task:
+
+        @task
+        @register_task(version=2)
+        def myfunction(a, b):
+            ...
+
+    Args:
+      f: A function defined at the top level of an importable module.
+      version: Optional version; a task is only run by code registered with the same version,
+        and is retried otherwise.
+    """
+    if not f:
+        return functools.partial(register_task, version=version)
+    _registeredtasks["%s.%s" % (f.__module__, f.__name__)] = (f, version)
+    return f
+
+
+def _get_taskref(f):
+    path = "%s.%s" % (getattr(f, '__module__', None), getattr(f, '__name__', None))
+    registered = _registeredtasks.get(path)
+    return (path, registered[1]) if registered and registered[0] is f else None
+
+
+def _import_function(path, version):
+    registered = _registeredtasks.get(path)
+    if not registered:
+        # importing the module runs its register_task decorators
+        importlib.import_module(path.rpartition(".")[0])
+        registered = _registeredtasks.get(path)
+    if not registered:
+        raise PermanentTaskFailure("task function %s is not registered" % path)
+    func, registered_version = registered
+    if registered_version != version:
+        raise RetryTaskException("task function %s is version %s, task wants %s" % (path, registered_version, version))
+    return func
+
+
+@ndb.non_transactional()
+def _store_function(pickledf):
+    """Stores a pickled function under its hash, once per instance.
+
+    Returns:
+      The hash, or None if the function is too big to be cached.
+    """
+    if len(pickledf) > _MAX_CACHED_FUNCTION_BYTES:
+        return None
+    fhash = hashlib.sha1(pickledf).hexdigest()
+    if fhash not in _storedfunctionhashes:
+        _TaskFunction(id=fhash, data=pickledf).put()
+        memcache.set(_FUNCTION_CACHE_PREFIX + fhash, pickledf)
+        _storedfunctionhashes.add(fhash)
+    return fhash
+
+
+def _load_function(fhash):
+    """Gets a function stored by _store_function, via an in-instance LRU of unpickled functions."""
+    with _loadedfunctionslock:
+        func = _loadedfunctions.pop(fhash, None)
+        if func is not None:
+            _loadedfunctions[fhash] = func
+            return func
+
+    pickledf = memcache.get(_FUNCTION_CACHE_PREFIX + fhash)
+    if pickledf is None:
+        entity = _TaskFunction.get_by_id(fhash)
+        if not entity:
+            raise PermanentTaskFailure("task function %s not found" % fhash)
+        pickledf = entity.data
+        memcache.add(_FUNCTION_CACHE_PREFIX + fhash, pickledf)
+    func = pickle.loads(pickledf)
+
+    with _loadedfunctionslock:
+        _loadedfunctions[fhash] = func
+        while len(_loadedfunctions) > _MAX_LOADED_FUNCTIONS:
+            _loadedfunctions.popitem(last=False)
+    return func
+
+
+def _run(data, headers, name=None):
     """Unpickles and executes a task.
     
     Args:
-      data: A pickled tuple of (function, args, kwargs) to execute.
+      data: A pickled tuple of (function, args, kwargs) to execute, possibly compressed.
+      name: The task's name. If given, and there's a metrics sink, timings are recorded under it.
     Returns:
       The return value of the function invocation.
     """
+    sink = get_metricssink() if name else None
     try:
-        func, args, kwargs, extra = pickle.loads(data)
+        started = time.time()
+        func, args, kwargs, extra = pickle.loads(_decompress_payload(data))
+        if sink:
+            sink.record(name, "unpicklesec", time.time() - started)
     except Exception, e:
         raise PermanentTaskFailure(e)
     else:
         if extra.get("_run_from_datastore"):
-            _run_from_datastore(headers, args[0])
+            _run_from_datastore(headers, args[0], name)
+        elif extra.get("_run_from_spillstore"):
+            _run_from_spillstore(headers, args[0], args[1], name)
         else:
-            if extra.get("includeheaders"):
-                kwargs["headers"] = headers
-            func(*args, **kwargs)
+            if extra.get("_fref"):
+                func = _import_function(*extra["_fref"])
+            elif extra.get("_fhash"):
+                func = _load_function(extra["_fhash"])
+            started = time.time()
+            if extra.get("_batch"):
+                _run_batch(func, args[0], extra, headers)
+            else:
+                if extra.get("includeheaders"):
+                    kwargs["headers"] = headers
+                func(*args, **kwargs)
+            if sink:
+                sink.record(name, "execsec", time.time() - started)
+
+
+# how many times to try enqueueing a batch's failed calls
+_BATCH_RETRY_ADD_ATTEMPTS = 3
 
 
-def _run_from_datastore(headers, key):
+def _run_batch(func, calls, extra, headers):
+    """Runs each call from a task(batch=N) task on its own, and re-enqueues just the ones that failed.
+
+    Args:
+      func: The function to call.
+      calls: A list of (args, kwargs) tuples.
+      extra: The task's extra dictionary, including the settings needed to re-enqueue it.
+      headers: The task's headers.
+    """
+    failed = []
+    for callargs, callkwargs in calls:
+        try:
+            if extra.get("includeheaders"):
+                func(*callargs, headers=headers, **callkwargs)
+            else:
+                func(*callargs, **callkwargs)
+        except PermanentTaskFailure:
+            logexception("Aborting call in batch")
+        except Exception:
+            logexception("call in batch failed")
+            failed.append((callargs, callkwargs))
+
+    if failed:
+        task_kw, batch_retries = extra["_batchtask"]
+        retries = extra.get("_batchretrycount", 0) + 1
+        if batch_retries is not None and retries > batch_retries:
+            logwarning("giving up on %s failed calls in batch after %s retries", len(failed), retries - 1)
+            return
+
+        logwarning("re-enqueuing %s of %s calls in batch", len(failed), len(calls))
+        retry_kw = dict(task_kw, countdown=min(2 ** retries, 600))
+        retry_kw.pop("eta", None)
+        # made like any other task, so it's compressed, spilled or stored in the datastore as needed
+        t = task(func, **retry_kw)._make_task(
+            (failed,), {}, {"_batch": True, "_batchtask": extra["_batchtask"], "_batchretrycount": retries})
+        queue = retry_kw.get("queue", "default")
+        for attempt in range(_BATCH_RETRY_ADD_ATTEMPTS):
+            try:
+                _add_task(t, queue, False)
+                break
+            except (taskqueue.TransientError, taskqueue.InternalError):
+                # failing here reruns the calls that succeeded, so try hard not to
+                if attempt + 1 == _BATCH_RETRY_ADD_ATTEMPTS:
+                    raise
+                logwarning("retrying enqueue of failed calls in batch")
+
+
+def _run_from_datastore(headers, key, name=None):
     """Retrieves a task from the datastore and executes it.
     
     Args:
       key: The datastore key of a _DeferredTaskEntity storing the task.
+      name: The task's name, for metrics.
     Returns:
       The return value of the function invocation.
     """
@@ -91,7 +489,7 @@ def _run_from_datastore(headers, key):
     entity = key.get() if key and isinstance(key, ndb.Key) else None
     if entity:
         try:
-            _run(entity.data, headers)
+            _run(entity.data, headers, name)
         except PermanentTaskFailure:
             key.delete()
             entity._deleted = True
@@ -101,6 +499,34 @@ def _run_from_datastore(headers, key):
             entity._deleted = True
 
 
+def _run_from_spillstore(headers, store, ref, name=None):
+    """Retrieves a task from a spill store and executes it.
+
+    Args:
+      store: The store the task was written to.
+      ref: The reference returned when the task was written.
+      name: The task's name, for metrics.
+    """
+    logwarning("running task from spill store")
+    data = store.read(ref)
+    if data is not None:
+        try:
+            _run(data, headers, name)
+        except PermanentTaskFailure:
+            _delete_spilled(store, ref)
+            raise
+        else:
+            _delete_spilled(store, ref)
+
+
+def _delete_spilled(store, ref):
+    # cleanup is best effort, whatever is left behind can be removed later
+    try:
+        store.delete(ref)
+    except Exception:
+        logexception("failed to delete spilled task %s", ref)
+
+
 def task(f=None, **kw):
     if not f:
         return functools.partial(task, **kw)
@@ -111,22 +537,69 @@ def task(f=None, **kw):
     transactional = task_kwargs.pop("transactional", False)
     parent = task_kwargs.pop("parent", None)
     include_headers = task_kwargs.pop("includeheaders", False)
+    compress_threshold = task_kwargs.pop("compressthreshold", None)
+    cache_function = task_kwargs.pop("cachefunction", False)
+    pull = task_kwargs.pop("pull", False)
+    batch_size = task_kwargs.pop("batch", None)
+    linger_ms = task_kwargs.pop("lingerms", None)
+    batch_retries = task_kwargs.pop("batchretries", None)
     log_name = task_kwargs.pop("logname", "%s/%s" % (getattr(f, '__module__', 'none'), getattr(f, '__name__', 'none')))
 
-    task_kwargs["headers"] = dict(_TASKQUEUE_HEADERS)
+    if pull:
+        # pull tasks have no url or headers, the tag lets the worker name them
+        task_kwargs["method"] = "PULL"
+        task_kwargs["tag"] = task_kwargs.get("tag", log_name)
+        max_inline_payload = _MAX_INLINE_PULL_PAYLOAD_BYTES
+    else:
+        task_kwargs["headers"] = dict(_TASKQUEUE_HEADERS)
 
-    url = get_enqueue_url(log_name)  # _DEFAULT_ENQUEUE_URL % logname
+        url = get_enqueue_url(log_name)  # _DEFAULT_ENQUEUE_URL % logname
 
-    task_kwargs["url"] = url.lower()
+        task_kwargs["url"] = url.lower()
+        max_inline_payload = _MAX_INLINE_PAYLOAD_BYTES
 
     logdebug(task_kwargs)
 
+    # the name tasks are run under, from the url
+    metrics_name = log_name.lower()
+
+    if batch_size and (transactional or "name" in task_kwargs):
+        raise ValueError("batched tasks can't be transactional or named")
+
     extra = {"includeheaders": include_headers}
 
-    @functools.wraps(f)
-    def run_task(*args, **kwargs):
-        pickled = cloudpickle.dumps((f, args, kwargs, extra))
-        logdebug("task pickle length: %s" % len(pickled))
+    batch_token = uuid.uuid4().hex
+    # what _run_batch needs to make the task for a batch's failed calls the same way
+    batch_task_kw = dict((key, value) for key, value in kw.items() if key not in ("batch", "lingerms", "batchretries"))
+    batch_task = (dict(batch_task_kw, logname=log_name), batch_retries)
+
+    taskref = _get_taskref(f)
+
+    functionhash = []  # filled in on first use when cache_function is set
+
+    def get_functionhash():
+        if not functionhash:
+            functionhash.append(_store_function(cloudpickle.dumps(f)))
+        return functionhash[0]
+
+    def make_task(args, kwargs, task_extra=None, name=None):
+        sink = get_metricssink()
+        ltask_kwargs = dict(task_kwargs, name=name) if name else task_kwargs
+        started = time.time()
+        lextra = dict(extra, **task_extra) if task_extra else extra
+        fhash = get_functionhash() if cache_function and not taskref else None
+        if taskref:
+            pickled = cloudpickle.dumps((None, args, kwargs, dict(lextra, _fref=taskref)))
+        elif fhash:
+            pickled = cloudpickle.dumps((None, args, kwargs, dict(lextra, _fhash=fhash)))
+        else:
+            pickled = cloudpickle.dumps((f, args, kwargs, lextra))
+        logdebug("task pickle length: %s", len(pickled))
+        pickled = _compress_payload(pickled,
+                                    compress_threshold if compress_threshold is not None else get_compressthreshold())
+        if sink:
+            sink.record(metrics_name, "serializesec", time.time() - started)
+            sink.record(metrics_name, "payloadbytes", len(pickled))
         if get_dump():
             logdebug("f:")
             dumper(f)
@@ -135,18 +608,79 @@ def task(f=None, **kw):
             logdebug("kwargs:")
             dumper(kwargs)
             logdebug("extra:")
-            dumper(extra)
-        try:
-            t = taskqueue.Task(payload=pickled, **task_kwargs)
-            return t.add(queue, transactional=transactional)
-        except taskqueue.TaskTooLargeError:
+            dumper(lextra)
+        if len(pickled) <= max_inline_payload:
+            try:
+                return taskqueue.Task(payload=pickled, **ltask_kwargs)
+            except taskqueue.TaskTooLargeError:
+                pass  # the url and headers pushed it over
+
+        spillstore = get_spillstore()
+        if spillstore and len(pickled) > get_spillthreshold():
+            if sink:
+                sink.record(metrics_name, "spillbytes", len(pickled))
+            ref = spillstore.write(pickled)
+            spill_pickled = cloudpickle.dumps((None, [spillstore, ref], {}, {"_run_from_spillstore": True}))
+            return taskqueue.Task(payload=spill_pickled, **ltask_kwargs)
+        else:
+            if sink:
+                sink.record(metrics_name, "datastorebytes", len(pickled))
             if parent:
                 key = _TaskToRun(data=pickled, parent=parent).put()
             else:
                 key = _TaskToRun(data=pickled).put()
             ds_pickled = cloudpickle.dumps((None, [key], {}, {"_run_from_datastore": True}))
-            t = taskqueue.Task(payload=ds_pickled, **task_kwargs)
-            return t.add(queue, transactional=transactional)
+            return taskqueue.Task(payload=ds_pickled, **ltask_kwargs)
+
+    def flush(batch=None):
+        """Sends any calls buffered by batch=N as one task, via batch or the current TaskBatch if there is one."""
+        calls = _pop_microbatch(batch_token)
+        if not calls:
+            return None
+        logdebug("sending %s calls in one task", len(calls))
+        t = make_task((calls,), {}, {"_batch": True, "_batchtask": batch_task})
+        batch = batch or _get_currentbatch()
+        if batch:
+            return batch.add(t, queue, transactional)
+        return _add_task(t, queue, transactional)
+
+    @functools.wraps(f)
+    def run_task(*args, **kwargs):
+        if batch_size:
+            currentbatch = _get_currentbatch()
+            if not currentbatch:
+                # nothing would be sure to send buffered calls, and threads outlive requests
+                raise ValueError("call batch=N task functions inside a TaskBatch")
+            calls, started = _buffer_call(batch_token, (args, kwargs))
+            currentbatch._attach(batch_token, flush)
+            if len(calls) >= batch_size or (linger_ms is not None and (time.time() - started) * 1000 >= linger_ms):
+                return flush()
+            return None
+
+        t = make_task(args, kwargs)
+        batch = _get_currentbatch()
+        if batch:
+            return batch.add(t, queue, transactional)
+        sink = get_metricssink()
+        if sink:
+            started = time.time()
+            result = _add_task(t, queue, transactional)
+            sink.record(metrics_name, "enqueuesec", time.time() - started)
+            return result
+        return _add_task(t, queue, transactional)
+
+    def add_async(*args, **kwargs):
+        """Enqueues the task without waiting, and returns the RPC. Not affected by TaskBatch."""
+        return _add_tasks_async(make_task(args, kwargs), queue, transactional)
+
+    def build_task(args, kwargs=None, name=None):
+        """Returns the task for a call without enqueueing it, eg: to add many tasks at once."""
+        return make_task(tuple(args), kwargs or {}, name=name)
+
+    run_task.add_async = add_async
+    run_task.flush = flush
+    run_task.make_task = build_task
+    run_task._make_task = make_task
 
     return run_task
 
@@ -176,14 +710,22 @@ def _launch_task(pickled, name, headers):
         #             if k.startswith("x-appengine-") and k not in _SKIP_HEADERS:
         #                 dheaders.append("%s:%s" % (key, value))
         #         logdebug(", ".join(dheaders))
-        logdebug(", ".join(["%s:%s" % (key, value) for key, value in headers.items()]))
+        logdebug(lambda: ", ".join(["%s:%s" % (key, value) for key, value in headers.items()]))
 
         if not isFromTaskQueue(headers):
             raise PermanentTaskFailure('Detected an attempted XSRF attack: we are not executing from a task queue.')
 
-        logdebug('before run "%s"' % name)
-        _run(pickled, headers)
-        logdebug('after run "%s"' % name)
+        sink = get_metricssink()
+        if sink:
+            sink.record(name, "retrycount", int(headers.get("X-AppEngine-TaskRetryCount") or 0))
+            started = time.time()
+
+        logdebug('before run "%s"', name)
+        _run(pickled, headers, name if sink else None)
+        logdebug('after run "%s"', name)
+
+        if sink:
+            sink.record(name, "runsec", time.time() - started)
     except PermanentTaskFailure:
         logexception("Aborting task")
     except:
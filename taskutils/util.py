@@ -1,5 +1,6 @@
 import datetime
 import logging
+import random
 import time
 import types
 
@@ -16,19 +17,38 @@ def get_utcnow_unixtimestampusec():
     return datetime_to_unixtimestampusec(datetime.datetime.utcnow())
 
 
-def logdebug(message):
-    if taskutils.get_logging():
-        logging.debug(message)
+def _formatmessage(message, args):
+    # only called once we know the message will be logged
+    if callable(message):
+        message = message()
+    return message % args if args else message
+
+
+def logdebug(message, *args):
+    """Logs at debug level, if logging is on.
+
+    Formatting is deferred until the message is known to be wanted, so pass values as args
+    (logdebug("key: %s", key)) rather than formatting them in, and pass a callable for anything
+    expensive to build (logdebug(lambda: json.dumps(results))).
+    """
+    if taskutils.get_logging() and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(_formatmessage(message, args))
+
+
+def logdebugsampled(rate, message, *args):
+    """Like logdebug, but only logs a random fraction (rate) of the calls. For per item messages in loops."""
+    if taskutils.get_logging() and random.random() < rate:
+        logdebug(message, *args)
 
 
-def logwarning(message):
+def logwarning(message, *args):
     if taskutils.get_logging():
-        logging.warning(message)
+        logging.warning(_formatmessage(message, args))
 
 
-def logexception(message):
+def logexception(message, *args):
     if taskutils.get_logging():
-        logging.exception(message)
+        logging.exception(_formatmessage(message, args))
 
 
 def get_dump():
@@ -38,19 +58,19 @@ def get_dump():
 def dumper(thing):
     if taskutils.get_dump():
         def printf(f, indent, foundf):
-            logdebug("%s [%s] %s" % ("#" * (indent + 1), len(cloudpickle.dumps(f)), f))
-            logdebug("%s code size = %s" % ("#" * (indent + 1), len(cloudpickle.dumps(f.func_code))))
+            logdebug("%s [%s] %s", "#" * (indent + 1), len(cloudpickle.dumps(f)), f)
+            logdebug("%s code size = %s", "#" * (indent + 1), len(cloudpickle.dumps(f.func_code)))
             #             print "%s closure size = %s" % ("#" * indent, len(cloudpickle.dumps(f.func_closure)))
             dodumpclosure(f, (indent + 1), foundf + [f])
 
         def printi(arg, indent):
-            logdebug("%s [%s] %s" % ("#" * (indent + 1), len(cloudpickle.dumps(arg)), arg))
+            logdebug("%s [%s] %s", "#" * (indent + 1), len(cloudpickle.dumps(arg)), arg)
 
         def printlen(obj, indent):
-            logdebug("%s [%s] %s" % ("#" * (indent + 1), len(obj), type(obj)))
+            logdebug("%s [%s] %s", "#" * (indent + 1), len(obj), type(obj))
 
         def printmsg(msg, indent):
-            logdebug("%s %s" % ("*" * (indent + 1), msg))
+            logdebug("%s %s", "*" * (indent + 1), msg)
 
         def dodumpitem(item, indent, foundf):
             if isinstance(item, types.FunctionType):